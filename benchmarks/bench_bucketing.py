@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+'''Padding and forward time of point-count bucketed batches against batches padded to the largest sample.'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import mxnet as mx
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_utils
+from pointcnn import PointCNN
+from setting_mnist import setting
+
+
+def time_forward(net, batch_size, point_num, repeat):
+    points = mx.nd.random.uniform(-1, 1, shape=(batch_size, point_num, 3))
+    net(points).wait_to_read()
+    start = time.time()
+    for _ in range(repeat):
+        net(points).wait_to_read()
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filelist', '-f', help='Path to a segmentation filelist or shard index with data_num, '
+                                                 'synthetic log-normal point counts if not given')
+    parser.add_argument('--sample_num', '-n', help='Number of synthetic samples', type=int, default=4096)
+    parser.add_argument('--point_num_min', help='Min synthetic point count', type=int, default=128)
+    parser.add_argument('--point_num_max', help='Max synthetic point count', type=int, default=1024)
+    parser.add_argument('--bucket_num', help='Number of buckets', type=int, default=8)
+    parser.add_argument('--batch_size', '-b', help='Batch size', type=int, default=8)
+    parser.add_argument('--repeat', '-r', help='Timed forward passes per point count', type=int, default=3)
+    args = parser.parse_args()
+    print(args)
+
+    if args.filelist:
+        point_nums = data_utils.load_point_nums(args.filelist)
+    else:
+        point_nums = np.random.lognormal(np.log(args.point_num_min * 2), 0.6, args.sample_num)
+        point_nums = np.clip(point_nums, args.point_num_min, args.point_num_max).astype(np.int64)
+
+    sampler = data_utils.BucketBatchSampler(point_nums, args.batch_size, args.bucket_num)
+    padding_bucketed, padding_max = sampler.padding_ratio()
+    print('buckets: %s' % sampler.boundaries.tolist())
+    print('padding: %.1f%% bucketed, %.1f%% at max point count' % (padding_bucketed * 100, padding_max * 100))
+
+    # the forward time only depends on the point count, so time each bucket once and weight it by its batches
+    net = PointCNN(setting, 'classification', with_feature=False, prefix="PointCNN_")
+    net.initialize(mx.init.Xavier(magnitude=2.))
+    batch_point_nums = [sampler.batch_point_num(batch) for batch in sampler]
+    times = {point_num: time_forward(net, args.batch_size, point_num, args.repeat)
+             for point_num in sampler.boundaries.tolist()}
+    time_bucketed = sum(times[point_num] for point_num in batch_point_nums)
+    time_max = len(batch_point_nums) * times[int(np.max(point_nums))]
+
+    sample_total = len(batch_point_nums) * args.batch_size
+    print('%-16s %12s %14s' % ('', 'epoch', 'samples/s'))
+    print('%-16s %11.3fs %14.1f' % ('max point count', time_max, sample_total / time_max))
+    print('%-16s %11.3fs %14.1f' % ('bucketed', time_bucketed, sample_total / time_bucketed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+'''Compare the peak memory and FLOPs predicted by costmodel with measured training and inference runs.'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import resource
+import subprocess
+import numpy as np
+import mxnet as mx
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import costmodel
+from pointcnn import get_loss_sym
+from mxutils import get_shape
+
+
+def current_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+# peak RSS growth of binding and running the network, relative to the process right before binding
+def measure(setting, batch_size, sample_num, training, repeat):
+    probs = costmodel.build_symbol(setting, batch_size, sample_num)
+    if training:
+        label = mx.sym.var('softmax_label', shape=(batch_size, get_shape(probs)[1]))
+        sym = get_loss_sym(probs, label)
+        label_shapes = [('softmax_label', (batch_size, get_shape(probs)[1]))]
+    else:
+        sym = probs
+        label_shapes = None
+    mod = mx.mod.Module(sym, data_names=('data',), label_names=('softmax_label',) if training else None,
+                        context=mx.cpu())
+    baseline = current_rss()
+    mod.bind(data_shapes=[('data', (batch_size, sample_num, 3))], label_shapes=label_shapes, for_training=training)
+    mod.init_params(initializer=mx.init.Xavier(magnitude=2.))
+    if training:
+        mod.init_optimizer(optimizer='sgd', optimizer_params={'learning_rate': 0.01, 'momentum': 0.9})
+    data = [mx.nd.random.uniform(-1, 1, shape=(batch_size, sample_num, 3))]
+    labels = [mx.nd.zeros(label_shapes[0][1])] if training else None
+    batch = mx.io.DataBatch(data=data, label=labels)
+    times = []
+    for _ in range(repeat + 1):
+        start = time.time()
+        mod.forward(batch, is_train=training)
+        if training:
+            mod.backward()
+            mod.update()
+        mx.nd.waitall()
+        times.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    return {'peak_bytes': peak, 'time': float(np.median(times[1:]))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setting', '-s', help='Setting module to analyze', default='setting_mnist')
+    parser.add_argument('--batch_sizes', '-b', help='Comma separated batch sizes', default='8,16,32,64')
+    parser.add_argument('--sample_num', '-n', help='Points per sample, the setting\'s if not given', type=int)
+    parser.add_argument('--budget', help='Memory budget (MB) to pick a training batch size for', type=float)
+    parser.add_argument('--repeat', '-r', help='Timed steps per run', type=int, default=3)
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    setting = importlib.import_module(args.setting).setting
+    sample_num = args.sample_num or setting.sample_num
+    if args.run:
+        batch_size, training = args.run.split(',')
+        print(json.dumps(measure(setting, int(batch_size), sample_num, training == 'train', args.repeat)))
+        return
+
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    print(costmodel.format_report(costmodel.analyze(setting, batch_sizes[0], sample_num)))
+    print()
+    print('%-6s %-6s %13s %13s %7s %10s %10s' % ('batch', 'mode', 'predicted MB', 'measured MB', 'ratio',
+                                                 'GFLOP/s', 'step ms'))
+    graph_peaks = {'inference': [], 'training': []}
+    measured_peaks = {'inference': [], 'training': []}
+    for batch_size in batch_sizes:
+        report = costmodel.analyze(setting, batch_size, sample_num)
+        for mode in ('infer', 'train'):
+            # each run is a fresh process so that its peak RSS is its own
+            command = [sys.executable, os.path.abspath(__file__), '--setting', args.setting, '--sample_num',
+                       str(sample_num), '--repeat', str(args.repeat), '--run', '%d,%s' % (batch_size, mode)]
+            output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    universal_newlines=True)
+            measured = json.loads(output.stdout.strip().splitlines()[-1])
+            mode_name = 'training' if mode == 'train' else 'inference'
+            predicted = report[mode_name + '_peak_bytes']
+            graph_peaks[mode_name].append(report['graph_%s_peak_bytes' % mode_name])
+            measured_peaks[mode_name].append(measured['peak_bytes'])
+            flops = report['training_flops' if mode == 'train' else 'forward_flops']
+            print('%-6d %-6s %13.1f %13.1f %7.2f %10.2f %10.1f' % (
+                batch_size, mode, predicted / 1e6, measured['peak_bytes'] / 1e6, measured['peak_bytes'] / predicted,
+                flops / measured['time'] / 1e9, measured['time'] * 1000))
+
+    # least squares (overhead, scale) of measured against graph estimates, to refit costmodel.CPU_CALIBRATION
+    if len(batch_sizes) > 1:
+        for mode_name in ('inference', 'training'):
+            scale, overhead = np.polyfit(graph_peaks[mode_name], measured_peaks[mode_name], 1)
+            print('fitted %s calibration: (%.1fe6, %.3f)' % (mode_name, overhead / 1e6, scale))
+
+    if args.budget:
+        batch_size = costmodel.max_batch_size(setting, sample_num, args.budget * 1e6)
+        print('largest training batch size within %.0fMB: %d' % (args.budget, batch_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+'''Compare h5py loading with the memory-mapped shard format.'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_utils
+
+
+def read_epoch(points, labels, batch_size):
+    order = np.random.permutation(len(labels))
+    total = 0.0
+    for begin in range(0, len(order), batch_size):
+        batch = np.sort(order[begin:begin + batch_size])
+        total += float(np.sum(points[batch][:, 0])) + float(np.sum(labels[batch]))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filelist', '-f', help='Path to a *_files.txt filelist', required=True)
+    parser.add_argument('--shards', '-s', help='Folder for the converted shards')
+    parser.add_argument('--batch_size', '-b', help='Batch size of the simulated epoch', type=int, default=32)
+    args = parser.parse_args()
+    print(args)
+
+    folder_shards = args.shards if args.shards else os.path.splitext(args.filelist)[0] + '_shards'
+    filename_index = os.path.join(folder_shards, 'index.json')
+    if not os.path.exists(filename_index):
+        start = time.time()
+        data_utils.convert_to_shards(args.filelist, folder_shards)
+        print('convert: %.3fs' % (time.time() - start))
+
+    start = time.time()
+    points, labels = data_utils.load_cls(args.filelist)
+    h5_cold = time.time() - start
+    start = time.time()
+    read_epoch(points, labels, args.batch_size)
+    h5_epoch = time.time() - start
+
+    start = time.time()
+    dataset = data_utils.H5Dataset(args.filelist)
+    h5_lazy_cold = time.time() - start
+    start = time.time()
+    for _ in dataset.iter_batches(args.batch_size):
+        pass
+    h5_lazy_epoch = time.time() - start
+    dataset.close()
+
+    start = time.time()
+    points, labels = data_utils.load_cls(filename_index)
+    shard_cold = time.time() - start
+    start = time.time()
+    read_epoch(points, labels, args.batch_size)
+    shard_epoch = time.time() - start
+
+    print('%-16s %12s %12s' % ('', 'cold start', 'epoch'))
+    print('%-16s %11.3fs %11.3fs' % ('h5py load_cls', h5_cold, h5_epoch))
+    print('%-16s %11.3fs %11.3fs' % ('h5py streaming', h5_lazy_cold, h5_lazy_epoch))
+    print('%-16s %11.3fs %11.3fs' % ('memmap shards', shard_cold, shard_epoch))
+
+
+if __name__ == '__main__':
+    main()
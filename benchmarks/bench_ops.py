@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+'''Time and peak memory of the PointCNN building blocks on CPU, with the layer shapes of a setting.
+
+python bench_ops.py -o results.json                  # run every case, write the results
+python bench_ops.py -o new.json -c results.json      # also flag cases slower than the stored baseline
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib
+import resource
+import subprocess
+import numpy as np
+import mxnet as mx
+import mxnet.autograd as ag
+import mxnet.gluon as gluon
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pointcnn import PointCNN, xconv, batch_distance_matrix_general, knn_indices_general, sort_points, \
+    curvature_sampler
+from fpsop import farthest_point_sampling_cpu, gather_point_cpu
+from voxelop import voxel_grid_sampling_cpu
+
+
+# parameters and point counts of the xconv layers of a setting, in the order PointCNN runs them
+def get_layers(setting, batch_size):
+    layers = []
+    sample_num = setting.sample_num
+    pts_num = sample_num
+    for layer_idx, (K, D, P, C) in enumerate(setting.xconv_params):
+        qrs_num = sample_num if P == -1 else P
+        C_prev = setting.xconv_params[layer_idx - 1][-1] if layer_idx > 0 else 0
+        layers.append(dict(layer_idx=layer_idx, K=K, D=D, P=P, C=C, C_prev=C_prev, batch_size=batch_size,
+                           pts_num=pts_num, qrs_num=qrs_num))
+        pts_num = qrs_num
+    return layers
+
+
+def get_case_names(setting, batch_sizes):
+    names = []
+    for batch_size in batch_sizes:
+        for layer in get_layers(setting, batch_size):
+            suffix = 'b%d/l%d' % (batch_size, layer['layer_idx'])
+            names += ['distance_matrix/' + suffix, 'knn/' + suffix, 'sort_cxyz/' + suffix, 'sort_l2/' + suffix,
+                      'xconv/' + suffix]
+            if layer['P'] != -1:
+                names += ['fps_cpu/' + suffix, 'voxel_cpu/' + suffix, 'gather_cpu/' + suffix, 'curvature/' + suffix]
+        names.append('pointcnn_fwd_bwd/b%d' % batch_size)
+    return names
+
+
+# SymbolBlock over inputs of fixed shapes, hybridized like the inference path
+def bind(block, shapes, initialize=True):
+    inputs = [mx.sym.var('data%d' % i, shape=shape, dtype=np.float32) for i, shape in enumerate(shapes)]
+    outputs = block(*inputs)
+    net = gluon.SymbolBlock(outputs, inputs, params=block.collect_params())
+    if initialize:
+        net.collect_params().initialize(mx.init.Xavier(magnitude=2.))
+    net.hybridize(static_alloc=True, static_shape=True)
+    return net
+
+
+def random_indices(batch_size, query_num, point_num, k):
+    indices = np.empty((2, batch_size, query_num, k), dtype=np.float32)
+    indices[0] = np.arange(batch_size).reshape(-1, 1, 1)
+    indices[1] = np.random.randint(point_num, size=(batch_size, query_num, k))
+    return mx.nd.array(indices)
+
+
+# returns run(), a function running the case once and waiting for its result, and the case parameters
+def build_case(name, setting):
+    kind, batch_name = name.split('/')[:2]
+    batch_size = int(batch_name[1:])
+    if kind == 'pointcnn_fwd_bwd':
+        net = PointCNN(setting, 'classification', with_feature=False, prefix="PointCNN_")
+        block = bind(net, [(batch_size, setting.sample_num, 3)])
+        points = mx.nd.random.uniform(-1, 1, shape=(batch_size, setting.sample_num, 3))
+
+        def run():
+            with ag.record():
+                loss = mx.nd.mean(block(points))
+            loss.backward()
+            mx.nd.waitall()
+        return run, dict(batch_size=batch_size, sample_num=setting.sample_num)
+
+    layer = get_layers(setting, batch_size)[int(name.split('/')[2][1:])]
+    K, D, P, C = layer['K'], layer['D'], layer['P'], layer['C']
+    pts = mx.nd.random.uniform(-1, 1, shape=(batch_size, layer['pts_num'], 3))
+    qrs = pts[:, :layer['qrs_num'], :]
+    shapes = [qrs.shape, pts.shape]
+    if kind == 'distance_matrix':
+        block = bind(batch_distance_matrix_general(), shapes, initialize=False)
+        inputs = [qrs, pts]
+    elif kind == 'knn':
+        block = bind(knn_indices_general(K * D, True, setting.knn_backend or 'dense', setting.knn_tile_size,
+                                         setting.knn_max_bytes), shapes, initialize=False)
+        inputs = [qrs, pts]
+    elif kind in ('sort_cxyz', 'sort_l2'):
+        indices = random_indices(batch_size, layer['qrs_num'], layer['pts_num'], K)
+        block = bind(sort_points(kind[len('sort_'):]), [pts.shape, indices.shape], initialize=False)
+        inputs = [pts, indices]
+    elif kind == 'xconv':
+        if layer['layer_idx'] == 0:
+            C_pts_fts = C // 2
+            depth_multiplier = 4
+        else:
+            C_pts_fts = layer['C_prev'] // 4
+            depth_multiplier = int(np.ceil(C / layer['C_prev']))
+        xc = xconv(K, D, P, C, C_pts_fts, layer['C_prev'], setting.with_X_transformation, depth_multiplier,
+                   setting.sorting_method, setting.knn_backend or 'dense', setting.knn_tile_size,
+                   setting.knn_max_bytes, setting.channel_last or False, prefix='xconv_')
+        if layer['layer_idx'] == 0:
+            fts = None
+        else:
+            fts = mx.nd.random.uniform(-1, 1, shape=(batch_size, layer['pts_num'], layer['C_prev']))
+        inputs = [x for x in (pts, fts, qrs) if x is not None]
+        inputs_sym = [mx.sym.var(name, shape=x.shape, dtype=np.float32) if x is not None else None
+                      for name, x in zip(('pts', 'fts', 'qrs'), (pts, fts, qrs))]
+        block = gluon.SymbolBlock(xc(*inputs_sym), [s for s in inputs_sym if s is not None],
+                                  params=xc.collect_params())
+        block.collect_params().initialize(mx.init.Xavier(magnitude=2.))
+        block.hybridize(static_alloc=True, static_shape=True)
+    elif kind == 'curvature':
+        block = bind(curvature_sampler(K, P, setting.knn_backend or 'dense', setting.knn_tile_size,
+                                       setting.knn_max_bytes), [pts.shape], initialize=False)
+        inputs = [pts]
+    elif kind == 'fps_cpu':
+        pts_np = pts.asnumpy()
+        return lambda: farthest_point_sampling_cpu(pts_np, P), layer
+    elif kind == 'voxel_cpu':
+        pts_np = pts.asnumpy()
+        return lambda: voxel_grid_sampling_cpu(pts_np, P), layer
+    elif kind == 'gather_cpu':
+        pts_np = pts.asnumpy()
+        idx = farthest_point_sampling_cpu(pts_np, P)
+        return lambda: gather_point_cpu(pts_np, idx), layer
+    else:
+        raise ValueError('Unknown case: {}'.format(name))
+
+    def run():
+        block(*inputs)
+        mx.nd.waitall()
+    return run, layer
+
+
+def run_case(name, setting, repeat):
+    try:
+        run, params = build_case(name, setting)
+        run()  # warm up: binding and memory allocation
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+    except Exception as e:
+        return {'error': '%s: %s' % (type(e).__name__, str(e).splitlines()[0] if str(e) else '')}
+    return {'time': float(np.median(times)), 'time_min': float(np.min(times)), 'repeat': repeat,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'params': {k: v for k, v in params.items() if isinstance(v, int)}}
+
+
+# every case runs in its own process so that its peak RSS is not hidden by the cases before it
+def run_case_isolated(name, args):
+    command = [sys.executable, os.path.abspath(__file__), '--setting', args.setting, '--repeat', str(args.repeat),
+               '--run_case', name]
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    lines = output.stdout.strip().splitlines()
+    if output.returncode != 0 or not lines:
+        return {'error': 'exit code %d' % output.returncode}
+    return json.loads(lines[-1])
+
+
+# returns the names of the cases slower than the baseline by more than threshold, or larger when compare_rss,
+# and of the cases that fail but ran in the baseline
+def compare(results, baseline, threshold, compare_rss):
+    regressions = []
+    print('%-28s %10s %10s %8s %10s %10s' % ('case', 'base (ms)', 'new (ms)', 'ratio', 'base RSS', 'new RSS'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is not None and 'time_min' in base and 'time_min' not in result:
+            regressions.append(name)
+            print('%-28s %10.2f %10s  REGRESSION: %s' % (name, base['time_min'] * 1000, 'failed',
+                                                        result.get('error', 'no timing')))
+            continue
+        if base is None or 'time_min' not in base or 'time_min' not in result:
+            print('%-28s %s' % (name, 'not comparable: %s' % (result.get('error') or 'not in baseline')))
+            continue
+        # the fastest run is the least disturbed by other processes, so it is compared instead of the median
+        ratio = result['time_min'] / base['time_min']
+        rss_ratio = result['peak_rss_mb'] / base['peak_rss_mb']
+        flag = ''
+        if ratio > 1 + threshold or (compare_rss and rss_ratio > 1 + threshold):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-28s %10.2f %10.2f %8.2f %9.0fM %9.0fM%s' % (name, base['time_min'] * 1000, result['time_min'] * 1000,
+                                                             ratio, base['peak_rss_mb'], result['peak_rss_mb'], flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setting', '-s', help='Setting module providing the layer shapes', default='setting_mnist')
+    parser.add_argument('--batch_sizes', '-b', help='Comma separated batch sizes to sweep', default='8,32')
+    parser.add_argument('--cases', help='Only run the cases whose name starts with one of these (comma separated)')
+    parser.add_argument('--repeat', '-r', help='Timed runs per case', type=int, default=10)
+    parser.add_argument('--output', '-o', help='Path of the JSON results')
+    parser.add_argument('--compare', '-c', help='Path of baseline JSON results to compare with')
+    parser.add_argument('--threshold', '-t', help='Relative slowdown flagged as a regression', type=float,
+                        default=0.2)
+    parser.add_argument('--no_isolate', help='Run all cases in this process (peak RSS becomes cumulative)',
+                        action='store_true')
+    parser.add_argument('--run_case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    setting = importlib.import_module(args.setting).setting
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, setting, args.repeat)))
+        return
+
+    names = get_case_names(setting, [int(b) for b in args.batch_sizes.split(',')])
+    if args.cases:
+        names = [name for name in names if name.startswith(tuple(args.cases.split(',')))]
+
+    results = {}
+    for name in names:
+        result = run_case(name, setting, args.repeat) if args.no_isolate else run_case_isolated(name, args)
+        results[name] = result
+        if 'time' in result:
+            print('%-28s %10.3fms %8.0fMB' % (name, result['time'] * 1000, result['peak_rss_mb']))
+        else:
+            print('%-28s %s' % (name, result['error']))
+
+    if args.output:
+        meta = {'setting': args.setting, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'mxnet': mx.__version__,
+                'numpy': np.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                'cpu_count': os.cpu_count(), 'isolated': not args.no_isolate}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        # peak RSS is only comparable between runs that both isolated their cases
+        compare_rss = baseline['meta']['isolated'] and not args.no_isolate
+        regressions = compare(results, baseline['results'], args.threshold, compare_rss)
+        print('%d regression(s) over %.0f%%: %s' % (len(regressions), args.threshold * 100, ', '.join(regressions)))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+'''Test accuracy and training step time of the query sampling methods on the MNIST setting.
+
+Each method trains the same network from the same initial parameters and batches for --steps steps.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import mxnet as mx
+import mxnet.autograd as ag
+import mxnet.gluon as gluon
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_utils
+from pointcnn import PointCNN, PointCNNLoss, get_indices, SAMPLING_METHODS
+from setting_mnist import setting
+
+
+def build(batch_size, sample_num):
+    net = PointCNN(setting, 'classification', with_feature=False, prefix="PointCNN_")
+    data = mx.sym.var('data', shape=(batch_size, sample_num, 3), dtype=np.float32)
+    block = gluon.SymbolBlock(net(data), data, params=net.collect_params())
+    block.collect_params().initialize(mx.init.Xavier(magnitude=2.))
+    block.hybridize(static_alloc=True, static_shape=True)
+    return block
+
+
+def sample_points(points, batch_size, sample_num):
+    indices = get_indices(batch_size, sample_num, points.shape[1])
+    return mx.nd.array(points[indices[0], indices[1], :3])
+
+
+def evaluate(block, data_val, label_val, batch_size, sample_num):
+    correct = 0
+    batch_num = len(data_val) // batch_size
+    for batch_idx in range(batch_num):
+        points = data_val[batch_idx * batch_size:(batch_idx + 1) * batch_size]
+        probs = mx.nd.softmax(block(sample_points(points, batch_size, sample_num)), axis=-1)
+        predictions = np.argmax(mx.nd.mean(probs, axis=1).asnumpy(), axis=-1)
+        correct += np.sum(predictions == label_val[batch_idx * batch_size:(batch_idx + 1) * batch_size])
+    return correct / float(batch_num * batch_size)
+
+
+def run(method, data_train, label_train, data_val, label_val, args):
+    setting.sampling = method
+    np.random.seed(args.seed)
+    mx.random.seed(args.seed)
+    block = build(args.batch_size, setting.sample_num)
+    if args.init_params:
+        block.collect_params().load(args.init_params, ctx=mx.cpu())
+    trainer = gluon.Trainer(block.collect_params(), 'sgd', {'learning_rate': 0.01, 'momentum': 0.9})
+
+    times = []
+    for step in range(args.steps):
+        sample_indices = np.random.choice(len(data_train), args.batch_size, replace=False)
+        points = sample_points(data_train[sample_indices], args.batch_size, setting.sample_num)
+        labels = mx.nd.array(label_train[sample_indices])
+        start = time.time()
+        with ag.record():
+            probs = block(points)
+            loss = PointCNNLoss(probs, mx.nd.tile(mx.nd.expand_dims(labels, axis=-1), (1, probs.shape[1])))
+        loss.backward()
+        trainer.step(args.batch_size)
+        mx.nd.waitall()
+        times.append(time.time() - start)
+    accuracy = evaluate(block, data_val, label_val, args.batch_size, setting.sample_num)
+    return {'accuracy': accuracy, 'step_time': float(np.median(times[1:] if len(times) > 1 else times))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filelist', '-t', help='Path to training data filelist', default='./mnist/train_files.txt')
+    parser.add_argument('--filelist_val', '-v', help='Path to test data filelist', default='./mnist/test_files.txt')
+    parser.add_argument('--methods', '-m', help='Comma separated sampling methods',
+                        default=','.join(SAMPLING_METHODS))
+    parser.add_argument('--steps', '-s', help='Training steps per method', type=int, default=200)
+    parser.add_argument('--batch_size', '-b', help='Batch size', type=int, default=32)
+    parser.add_argument('--val_num', help='Number of test samples to evaluate on', type=int, default=1024)
+    parser.add_argument('--init_params', help='Parameters every method starts from, Xavier if not given')
+    parser.add_argument('--seed', help='Random seed shared by the methods', type=int, default=0)
+    args = parser.parse_args()
+    print(args)
+
+    data_train, label_train, data_val, label_val = data_utils.load_cls_train_val(args.filelist, args.filelist_val)
+    data_val, label_val = data_val[:args.val_num], label_val[:args.val_num]
+
+    results = {}
+    for method in args.methods.split(','):
+        results[method] = run(method, data_train, label_train, data_val, label_val, args)
+        print('%-10s accuracy %.2f%%, step %.1fms' % (method, results[method]['accuracy'] * 100,
+                                                      results[method]['step_time'] * 1000))
+
+    print()
+    print('%-10s %10s %12s' % ('method', 'accuracy', 'step (ms)'))
+    for method, result in results.items():
+        print('%-10s %9.2f%% %12.1f' % (method, result['accuracy'] * 100, result['step_time'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+'''Training throughput and scaling efficiency of data-parallel PointCNN on CPU, from 1 to N workers.
+
+python bench_scaling.py -n 4                  # worker processes over a dist_sync kvstore (launch_local.py)
+python bench_scaling.py -n 4 --mode context   # one process splitting the batch over cpu(0) .. cpu(n-1)
+
+Every worker or context keeps --batch_size samples per step, so efficiency is the throughput with n of them
+divided by n times the throughput with one.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import importlib
+import subprocess
+import numpy as np
+import mxnet as mx
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pointcnn import PointCNN, get_loss_sym
+from mxutils import get_shape, get_contexts, exit_on_exception
+
+
+# seconds per training step of a module over contexts, each running batch_size samples, aggregated through kv
+def measure(setting, contexts, kvstore, batch_size, steps):
+    ctx = get_contexts(contexts)
+    kv = mx.kv.create(kvstore)
+    if 'dist' in kv.type:
+        exit_on_exception()
+    net = PointCNN(setting, 'classification', with_feature=False, prefix="PointCNN_")
+    probs = net(mx.sym.var('data', shape=(batch_size, setting.sample_num, 3)))
+    label_num = get_shape(probs)[1]
+    sym = get_loss_sym(probs, mx.sym.var('softmax_label', shape=(batch_size, label_num)))
+    mod = mx.mod.Module(sym, data_names=('data',), label_names=('softmax_label',), context=ctx)
+    batch_shape = (batch_size * len(ctx), setting.sample_num, 3)
+    mod.bind(data_shapes=[('data', batch_shape)], label_shapes=[('softmax_label', (batch_shape[0], label_num))])
+    mod.init_params(initializer=mx.init.Xavier(magnitude=2.))
+    mod.init_optimizer(kvstore=kv, optimizer='sgd', optimizer_params={'learning_rate': 0.01, 'momentum': 0.9})
+    batch = mx.io.DataBatch(data=[mx.nd.random.uniform(-1, 1, shape=batch_shape)],
+                            label=[mx.nd.array(np.random.randint(setting.num_class, size=(batch_shape[0], label_num)))])
+    times = []
+    for _ in range(steps + 1):
+        start = time.time()
+        mod.forward(batch, is_train=True)
+        mod.backward()
+        mod.update()
+        mx.nd.waitall()
+        times.append(time.time() - start)
+    return kv.rank, {'step_time': float(np.median(times[1:])), 'samples': batch_shape[0] * kv.num_workers}
+
+
+def run(n, args):
+    command = [sys.executable, os.path.abspath(__file__), '--setting', args.setting, '--batch_size',
+               str(args.batch_size), '--steps', str(args.steps), '--mode', args.mode, '--run', str(n)]
+    if args.mode == 'process':
+        launcher = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'launch_local.py')
+        command = [sys.executable, launcher, '--num_workers', str(n)] + command
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    lines = output.stdout.strip().splitlines()
+    if output.returncode != 0 or not lines:
+        raise RuntimeError('%d workers failed with exit code %d' % (n, output.returncode))
+    result = json.loads(lines[-1])
+    result['throughput'] = result['samples'] / result['step_time']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setting', '-s', help='Setting module of the network', default='setting_mnist')
+    parser.add_argument('--num_workers', '-n', help='Largest number of workers', type=int, default=4)
+    parser.add_argument('--mode', '-m', help='Workers are processes or contexts of one process',
+                        choices=['process', 'context'], default='process')
+    parser.add_argument('--batch_size', '-b', help='Batch size per worker', type=int, default=16)
+    parser.add_argument('--steps', help='Timed training steps', type=int, default=5)
+    parser.add_argument('--run', help=argparse.SUPPRESS, type=int)
+    args = parser.parse_args()
+
+    setting = importlib.import_module(args.setting).setting
+    if args.run:
+        if args.mode == 'process':
+            rank, result = measure(setting, None, 'dist_sync', args.batch_size, args.steps)
+        else:
+            rank, result = measure(setting, ['cpu(%d)' % i for i in range(args.run)], 'local', args.batch_size,
+                                   args.steps)
+        # frees the kvstore before mxnet shuts down, see the end of pointcnn_cls.py
+        gc.collect()
+        if rank == 0:
+            print(json.dumps(result))
+        return
+
+    print('%d cores, %s mode, %d samples per worker' % (os.cpu_count(), args.mode, args.batch_size))
+    print('%-8s %12s %12s %12s %11s' % ('workers', 'batch', 'step (ms)', 'samples/s', 'efficiency'))
+    base = None
+    for n in range(1, args.num_workers + 1):
+        result = run(n, args)
+        base = base or result['throughput']
+        print('%-8d %12d %12.1f %12.1f %10.1f%%' % (n, result['samples'], result['step_time'] * 1000,
+                                                     result['throughput'], result['throughput'] / (n * base) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# coding: utf-8
+
+import re
+import json
+import collections
+
+import numpy as np
+import mxnet as mx
+
+from pointcnn import PointCNN
+
+# Memory and FLOP estimates of a setting, read off the symbolic graph of PointCNN: every node's output shape
+# comes from shape inference, FLOPs from the operator type and the shapes around it, and peak memory from a
+# simulation of which outputs are alive while the graph runs in order.
+
+# operators whose output is a view of their input
+VIEW_OPS = ('Reshape', 'reshape', 'expand_dims', 'squeeze', 'Flatten', '_copy', 'BlockGrad', 'identity')
+
+# gradients, optimizer state (sgd momentum) and weights
+TRAINING_PARAM_COPIES = 3
+
+# measured peak = overhead + scale * graph estimate, fit with benchmarks/bench_costmodel.py on CPU runs of
+# setting_mnist at batch sizes 8 to 64. The executor's memory planner and operator workspaces reuse memory
+# less than the liveness simulation for inference, while backward keeps fewer outputs than all of them.
+CPU_CALIBRATION = {'inference': (21.6e6, 2.02), 'training': (31.1e6, 0.655)}
+
+def build_symbol(setting, batch_size, sample_num, task='classification'):
+    net = PointCNN(setting, task, with_feature=False, prefix="PointCNN_")
+    return net(mx.sym.var('data', shape=(batch_size, sample_num, 3)))
+
+def get_layer_name(node_name):
+    match = re.search(r'_(xconv\d+|xdconv\d+)_', node_name)
+    if match:
+        return match.group(1)
+    if 'knn' in node_name or 'distance_matrix' in node_name:
+        return 'shared_knn'
+    return 'head'
+
+def get_flops(op, attrs, in_shapes, out_shape):
+    out_size = int(np.prod(out_shape))
+    if op == 'FullyConnected':
+        return 2 * out_size * in_shapes[1][1]
+    if op == 'Convolution':
+        kernel = [int(size) for size in re.findall(r'\d+', attrs['kernel'])]
+        groups = int(attrs.get('num_group', 1))
+        return 2 * out_size * (in_shapes[0][1] // groups) * int(np.prod(kernel))
+    if op == 'batch_dot':
+        k = in_shapes[0][1] if attrs.get('transpose_a') == 'True' else in_shapes[0][2]
+        return 2 * out_size * k
+    if op == '_linalg_gemm2':
+        k = in_shapes[0][-2] if attrs.get('transpose_a') == 'True' else in_shapes[0][-1]
+        return 2 * out_size * k
+    if op == 'topk':
+        return int(np.prod(in_shapes[0]))
+    if op in VIEW_OPS or op in ('_arange', 'tile', 'slice', 'transpose', 'gather_nd', 'Concat'):
+        return 0
+    return out_size
+
+# One record per operator node, in graph order: name, op, layer, output shape and bytes, flops and inputs
+def get_nodes(sym):
+    internals = sym.get_internals()
+    _, out_shapes, _ = internals.infer_shape_partial()
+    _, out_types, _ = internals.infer_type()
+    outputs = {name: (shape, np.dtype(dtype or np.float32).itemsize)
+               for name, shape, dtype in zip(internals.list_outputs(), out_shapes, out_types)}
+
+    graph = json.loads(sym.tojson())
+    shapes = []
+    nodes = []
+    for node in graph['nodes']:
+        name = node['name']
+        keys = [name] if node['op'] == 'null' else \
+            sorted(key for key in outputs if re.match(re.escape(name) + r'_output\d*$', key))
+        shapes.append([outputs[key] for key in keys])
+        if node['op'] == 'null':
+            continue
+        in_shapes = [shapes[i][j][0] for i, j, _ in node['inputs']]
+        out_shape, itemsize = shapes[-1][0]
+        nodes.append(dict(name=name, op=node['op'], layer=get_layer_name(name), shape=tuple(out_shape),
+                          bytes=0 if node['op'] in VIEW_OPS else int(np.prod(out_shape)) * itemsize,
+                          flops=get_flops(node['op'], node.get('attrs', {}), in_shapes, out_shape),
+                          inputs=[i for i, _, _ in node['inputs']], id=len(shapes) - 1))
+    param_bytes = sum(int(np.prod(shape)) * itemsize for node, outs in zip(graph['nodes'], shapes)
+                      if node['op'] == 'null' and node['name'] != 'data' for shape, itemsize in outs)
+    return nodes, param_bytes
+
+# Largest sum of outputs alive at once when the nodes run in order and every output is freed after its last use
+def simulate_peak(nodes):
+    last_use = {}
+    for idx, node in enumerate(nodes):
+        for i in node['inputs']:
+            last_use[i] = idx
+    node_by_id = {node['id']: node for node in nodes}
+    alive = 0
+    peak = 0
+    for idx, node in enumerate(nodes):
+        alive += node['bytes']
+        peak = max(peak, alive)
+        for i in set(node['inputs']):
+            if last_use.get(i) == idx and i in node_by_id:
+                alive -= node_by_id[i]['bytes']
+    return peak
+
+# Per-layer activation bytes and FLOPs, and the peak memory of inference and of a training step. The graph
+# estimate of training keeps every forward output for the backward pass plus room for the largest layer's
+# gradients; the predicted peaks are the graph estimates with the calibration applied.
+def analyze(setting, batch_size, sample_num, task='classification', calibration=CPU_CALIBRATION):
+    nodes, param_bytes = get_nodes(build_symbol(setting, batch_size, sample_num, task))
+    layers = collections.OrderedDict()
+    for node in sorted(nodes, key=lambda node: node['layer']):
+        layer = layers.setdefault(node['layer'], dict(activation_bytes=0, flops=0, largest=None))
+        layer['activation_bytes'] += node['bytes']
+        layer['flops'] += node['flops']
+        if layer['largest'] is None or node['bytes'] > layer['largest'][2]:
+            layer['largest'] = (node['name'], node['shape'], node['bytes'])
+
+    activation_bytes = sum(node['bytes'] for node in nodes)
+    largest_layer_bytes = max(layer['activation_bytes'] for layer in layers.values())
+    forward_flops = sum(node['flops'] for node in nodes)
+    graph_peaks = {'inference': param_bytes + simulate_peak(nodes),
+                   'training': TRAINING_PARAM_COPIES * param_bytes + activation_bytes + largest_layer_bytes}
+    peaks = {mode: calibration[mode][0] + calibration[mode][1] * peak if calibration else peak
+             for mode, peak in graph_peaks.items()}
+    return dict(batch_size=batch_size, sample_num=sample_num, layers=layers, param_bytes=param_bytes,
+                activation_bytes=activation_bytes, graph_inference_peak_bytes=graph_peaks['inference'],
+                graph_training_peak_bytes=graph_peaks['training'], inference_peak_bytes=peaks['inference'],
+                training_peak_bytes=peaks['training'], forward_flops=forward_flops, training_flops=3 * forward_flops)
+
+# Largest batch size whose predicted peak fits in memory_budget bytes, 0 if even a single sample does not.
+# Memory grows linearly with the batch size, so two analyses are enough to extrapolate; the result is checked.
+def max_batch_size(setting, sample_num, memory_budget, training=True, task='classification',
+                   calibration=CPU_CALIBRATION):
+    key = 'training_peak_bytes' if training else 'inference_peak_bytes'
+    peak_1 = analyze(setting, 1, sample_num, task, calibration)[key]
+    if peak_1 > memory_budget:
+        return 0
+    peak_2 = analyze(setting, 2, sample_num, task, calibration)[key]
+    per_sample = max(peak_2 - peak_1, 1)
+    batch_size = int((memory_budget - peak_1) // per_sample) + 1
+    while batch_size > 1 and analyze(setting, batch_size, sample_num, task, calibration)[key] > memory_budget:
+        batch_size -= 1
+    return batch_size
+
+def format_report(report):
+    lines = ['%-12s %14s %12s  %s' % ('layer', 'activations MB', 'GFLOPs', 'largest tensor')]
+    for name, layer in report['layers'].items():
+        largest_name, largest_shape, largest_bytes = layer['largest']
+        lines.append('%-12s %14.2f %12.3f  %s %s %.2fMB' % (name, layer['activation_bytes'] / 1e6, layer['flops'] / 1e9,
+                                                            largest_name, largest_shape, largest_bytes / 1e6))
+    lines.append('parameters %.2fMB, activations %.2fMB, forward %.3f GFLOPs' % (
+        report['param_bytes'] / 1e6, report['activation_bytes'] / 1e6, report['forward_flops'] / 1e9))
+    lines.append('predicted peak: inference %.1fMB, training %.1fMB' % (
+        report['inference_peak_bytes'] / 1e6, report['training_peak_bytes'] / 1e6))
+    return '\n'.join(lines)
@@ -3,85 +3,106 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
+import json
 import h5py
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import plyfile
 import numpy as np
 from matplotlib import cm
 import scipy.spatial.distance as distance
+from mxnet.gluon.data import Dataset, Sampler
 
 
-def save_ply(points, filename, colors=None, normals=None):
-    vertex = np.array([tuple(p) for p in points], dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
-    n = len(vertex)
-    desc = vertex.dtype.descr
+PLY_TYPES = {'f4': 'float', 'u1': 'uchar'}
 
-    if normals is not None:
-        vertex_normal = np.array([tuple(n) for n in normals], dtype=[('nx', 'f4'), ('ny', 'f4'), ('nz', 'f4')])
-        assert len(vertex_normal) == n
-        desc = desc + vertex_normal.dtype.descr
-
-    if colors is not None:
-        vertex_color = np.array([tuple(c * 255) for c in colors],
-                                dtype=[('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
-        assert len(vertex_color) == n
-        desc = desc + vertex_color.dtype.descr
 
-    vertex_all = np.empty(n, dtype=desc)
+def write_ply_binary(vertex_all, filename):
+    """Write a structured vertex array as a binary little endian ply, without going through plyfile."""
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % len(vertex_all)]
+    for name in vertex_all.dtype.names:
+        header.append('property %s %s' % (PLY_TYPES[vertex_all.dtype[name].str[1:]], name))
+    header.append('end_header\n')
+    with open(filename, 'wb') as ply_file:
+        ply_file.write('\n'.join(header).encode('ascii'))
+        if sys.byteorder != 'little':
+            vertex_all = vertex_all.astype(vertex_all.dtype.newbyteorder('<'))
+        vertex_all.tofile(ply_file)
 
-    for prop in vertex.dtype.names:
-        vertex_all[prop] = vertex[prop]
 
+def save_ply(points, filename, colors=None, normals=None, use_plyfile=True):
+    desc = [('x', 'f4'), ('y', 'f4'), ('z', 'f4')]
     if normals is not None:
-        for prop in vertex_normal.dtype.names:
-            vertex_all[prop] = vertex_normal[prop]
+        assert len(normals) == len(points)
+        desc = desc + [('nx', 'f4'), ('ny', 'f4'), ('nz', 'f4')]
+    if colors is not None:
+        assert len(colors) == len(points)
+        desc = desc + [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
 
+    vertex_all = np.empty(len(points), dtype=desc)
+    for idx, prop in enumerate(('x', 'y', 'z')):
+        vertex_all[prop] = points[:, idx]
+    if normals is not None:
+        for idx, prop in enumerate(('nx', 'ny', 'nz')):
+            vertex_all[prop] = normals[:, idx]
     if colors is not None:
-        for prop in vertex_color.dtype.names:
-            vertex_all[prop] = vertex_color[prop]
+        colors_u1 = (np.asarray(colors) * 255).astype(np.uint8)
+        for idx, prop in enumerate(('red', 'green', 'blue')):
+            vertex_all[prop] = colors_u1[:, idx]
 
-    ply = plyfile.PlyData([plyfile.PlyElement.describe(vertex_all, 'vertex')], text=False)
-    if not os.path.exists(os.path.dirname(filename)):
-        os.makedirs(os.path.dirname(filename))
-    ply.write(filename)
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # created meanwhile by another writer of the batch
+            pass
+    if use_plyfile:
+        ply = plyfile.PlyData([plyfile.PlyElement.describe(vertex_all, 'vertex')], text=False)
+        ply.write(filename)
+    else:
+        write_ply_binary(vertex_all, filename)
 
 
-def save_ply_property(points, property, property_max, filename, cmap_name='Set1'):
-    point_num = points.shape[0]
-    colors = np.full(points.shape, 0.5)
+def save_ply_property(points, property, property_max, filename, cmap_name='Set1', use_plyfile=True):
     cmap = cm.get_cmap(cmap_name)
-    for point_idx in range(point_num):
-        colors[point_idx] = cmap(property[point_idx] / property_max)[:3]
-    save_ply(points, filename, colors)
+    colors = cmap(np.asarray(property) / property_max)[:, :3]
+    save_ply(points, filename, colors, use_plyfile=use_plyfile)
+
+
+def get_batch_filenames(file_path, batch_size):
+    if type(file_path) == list:
+        return file_path
+    basename = os.path.splitext(file_path)[0]
+    return ['%s_%04d%s' % (basename, batch_idx, '.ply') for batch_idx in range(batch_size)]
 
 
-def save_ply_batch(points_batch, file_path, points_num=None):
+# the files of a batch are written by num_workers threads, plyfile and numpy release the GIL while writing
+def save_ply_batch(points_batch, file_path, points_num=None, num_workers=4, use_plyfile=True):
     batch_size = points_batch.shape[0]
-    if type(file_path) != list:
-        basename = os.path.splitext(file_path)[0]
-        ext = '.ply'
-    for batch_idx in range(batch_size):
+    filenames = get_batch_filenames(file_path, batch_size)
+
+    def save(batch_idx):
         point_num = points_batch.shape[1] if points_num is None else points_num[batch_idx]
-        if type(file_path) == list:
-            save_ply(points_batch[batch_idx][:point_num], file_path[batch_idx])
-        else:
-            save_ply(points_batch[batch_idx][:point_num], '%s_%04d%s' % (basename, batch_idx, ext))
+        save_ply(points_batch[batch_idx][:point_num], filenames[batch_idx], use_plyfile=use_plyfile)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        list(executor.map(save, range(batch_size)))
 
 
 def save_ply_property_batch(points_batch, property_batch, file_path, points_num=None, property_max=None,
-                            cmap_name='Set1'):
+                            cmap_name='Set1', num_workers=4, use_plyfile=True):
     batch_size = points_batch.shape[0]
-    if type(file_path) != list:
-        basename = os.path.splitext(file_path)[0]
-        ext = '.ply'
+    filenames = get_batch_filenames(file_path, batch_size)
     property_max = np.max(property_batch) if property_max is None else property_max
-    for batch_idx in range(batch_size):
+
+    def save(batch_idx):
         point_num = points_batch.shape[1] if points_num is None else points_num[batch_idx]
-        if type(file_path) == list:
-            save_ply_property(points_batch[batch_idx][:point_num], property_batch[batch_idx][:point_num],
-                              property_max, file_path[batch_idx], cmap_name)
-        else:
-            save_ply_property(points_batch[batch_idx][:point_num], property_batch[batch_idx][:point_num],
-                              property_max, '%s_%04d%s' % (basename, batch_idx, ext), cmap_name)
+        save_ply_property(points_batch[batch_idx][:point_num], property_batch[batch_idx][:point_num],
+                          property_max, filenames[batch_idx], cmap_name, use_plyfile)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        list(executor.map(save, range(batch_size)))
 
 
 def save_ply_point_with_normal(data_sample, folder):
@@ -103,18 +124,25 @@ def grouped_shuffle(inputs):
 
 
 def load_cls(filelist):
+    if filelist.endswith('.json'):
+        shards = load_shards(filelist)
+        points = shards['data']
+        if 'normal' in shards:
+            points = np.concatenate([points, shards['normal']], axis=-1)
+        return points, np.reshape(shards['label'], (-1,))
+
     points = []
     labels = []
 
     folder = os.path.dirname(filelist)
     for line in open(filelist):
         filename = os.path.basename(line.rstrip())
-        data = h5py.File(os.path.join(folder, filename))
-        if 'normal' in data:
-            points.append(np.concatenate([data['data'][...], data['data'][...]], axis=-1).astype(np.float32))
-        else:
-            points.append(data['data'][...].astype(np.float32))
-        labels.append(np.squeeze(data['label'][:]).astype(np.int32))
+        with h5py.File(os.path.join(folder, filename), 'r') as data:
+            if 'normal' in data:
+                points.append(np.concatenate([data['data'][...], data['normal'][...]], axis=-1).astype(np.float32))
+            else:
+                points.append(data['data'][...].astype(np.float32))
+            labels.append(np.squeeze(data['label'][:]).astype(np.int32))
     return (np.concatenate(points, axis=0),
             np.concatenate(labels, axis=0))
 
@@ -126,6 +154,10 @@ def load_cls_train_val(filelist, filelist_val):
 
 
 def load_seg(filelist):
+    if filelist.endswith('.json'):
+        shards = load_shards(filelist)
+        return shards['data'], shards['label'], shards['data_num'], shards['label_seg']
+
     points = []
     labels = []
     point_nums = []
@@ -134,12 +166,267 @@ def load_seg(filelist):
     folder = os.path.dirname(filelist)
     for line in open(filelist):
         filename = os.path.basename(line.rstrip())
-        data = h5py.File(os.path.join(folder, filename))
-        points.append(data['data'][...].astype(np.float32))
-        labels.append(data['label'][...].astype(np.int32))
-        point_nums.append(data['data_num'][...].astype(np.int32))
-        labels_seg.append(data['label_seg'][...].astype(np.int32))
+        with h5py.File(os.path.join(folder, filename), 'r') as data:
+            points.append(data['data'][...].astype(np.float32))
+            labels.append(data['label'][...].astype(np.int32))
+            point_nums.append(data['data_num'][...].astype(np.int32))
+            labels_seg.append(data['label_seg'][...].astype(np.int32))
     return (np.concatenate(points, axis=0),
             np.concatenate(labels, axis=0),
             np.concatenate(point_nums, axis=0),
             np.concatenate(labels_seg, axis=0))
+
+
+SHARD_KEYS = ('data', 'normal', 'label', 'data_num', 'label_seg')
+
+
+def convert_to_shards(filelist, folder_out, chunk_size=1024):
+    """Convert the .h5 files of a filelist to one contiguous binary file per key (float32 for points and
+    normals, int32 for the rest) plus an index.json describing them, to be read back with load_shards.
+    Samples are copied chunk by chunk, so the dataset never has to fit in memory.
+    """
+    with h5py.File(H5Dataset(filelist).filenames[0], 'r') as data:
+        keys = tuple(key for key in SHARD_KEYS if key in data)
+    dataset = H5Dataset(filelist, keys)
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+
+    index = {'num': len(dataset), 'keys': {}}
+    shards = {}
+    first = dataset.read(0, 0, 1)
+    for key, value in zip(keys, first):
+        filename = '%s.bin' % key
+        shape = (len(dataset),) + value.shape[1:]
+        index['keys'][key] = {'file': filename, 'dtype': value.dtype.str, 'shape': shape}
+        shards[key] = np.memmap(os.path.join(folder_out, filename), dtype=value.dtype, mode='w+', shape=shape)
+    for file_idx in range(len(dataset.filenames)):
+        file_size = dataset.offsets[file_idx + 1] - dataset.offsets[file_idx]
+        for begin in range(0, file_size, chunk_size):
+            end = min(begin + chunk_size, file_size)
+            for key, value in zip(keys, dataset.read(file_idx, begin, end)):
+                shards[key][dataset.offsets[file_idx] + begin:dataset.offsets[file_idx] + end] = value
+    dataset.close()
+    for shard in shards.values():
+        shard.flush()
+    filename_index = os.path.join(folder_out, 'index.json')
+    with open(filename_index, 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+    return filename_index
+
+
+def load_shards(filename_index):
+    """Memory-map the shards described by an index.json written by convert_to_shards. Nothing is read until
+    samples are accessed, and slicing a sample returns a view into the page cache.
+    """
+    folder = os.path.dirname(filename_index)
+    with open(filename_index) as index_file:
+        index = json.load(index_file)
+    return {key: np.memmap(os.path.join(folder, desc['file']), dtype=np.dtype(desc['dtype']), mode='r',
+                           shape=tuple(desc['shape']))
+            for key, desc in index['keys'].items()}
+
+
+class H5Dataset(Dataset):
+    """Samples of the .h5 files listed in a filelist, read lazily instead of loaded into memory.
+    keys are the per-sample datasets returned by __getitem__, e.g. ('data', 'label') for classification
+    or ('data', 'label', 'data_num', 'label_seg') for segmentation. Float data is returned as float32,
+    everything else as int32.
+    """
+    def __init__(self, filelist, keys=('data', 'label')):
+        folder = os.path.dirname(filelist)
+        self.filenames = [os.path.join(folder, os.path.basename(line.rstrip())) for line in open(filelist)
+                          if line.strip()]
+        self.keys = keys
+        sizes = []
+        for filename in self.filenames:
+            with h5py.File(filename, 'r') as data:
+                sizes.append(data[keys[0]].shape[0])
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self._files = {}
+        self._pid = os.getpid()
+
+    def _file(self, file_idx):
+        # h5py handles must not be shared with forked DataLoader workers
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if file_idx not in self._files:
+            self._files[file_idx] = h5py.File(self.filenames[file_idx], 'r')
+        return self._files[file_idx]
+
+    def _convert(self, value):
+        return value.astype(np.float32 if value.dtype.kind == 'f' else np.int32)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('index {} is out of range for {} samples'.format(idx, len(self)))
+        file_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        data = self._file(file_idx)
+        local_idx = idx - self.offsets[file_idx]
+        return tuple(self._convert(data[key][local_idx]) for key in self.keys)
+
+    def read(self, file_idx, begin, end):
+        data = self._file(file_idx)
+        return tuple(self._convert(data[key][begin:end]) for key in self.keys)
+
+    def iter_batches(self, batch_size, shuffle=True, shuffle_buffer=4096, chunk_size=256, drop_last=False):
+        """Yield tuples of (batch_size, ...) arrays. Files are visited in random order and read in chunks of
+        chunk_size samples, samples are shuffled through a buffer of at most shuffle_buffer + chunk_size
+        samples, so memory use does not depend on the size of the dataset.
+        """
+        file_indices = np.arange(len(self.filenames))
+        if shuffle:
+            np.random.shuffle(file_indices)
+
+        def chunks():
+            for file_idx in file_indices:
+                file_size = self.offsets[file_idx + 1] - self.offsets[file_idx]
+                chunk_begins = np.arange(0, file_size, chunk_size)
+                if shuffle:
+                    np.random.shuffle(chunk_begins)
+                for begin in chunk_begins:
+                    yield self.read(file_idx, begin, min(begin + chunk_size, file_size))
+
+        buffer = []
+        batch = []
+        for chunk in chunks():
+            buffer.extend(zip(*chunk))
+            while len(buffer) > (shuffle_buffer if shuffle else 0):
+                if shuffle:
+                    pick = np.random.randint(len(buffer))
+                    buffer[pick], buffer[-1] = buffer[-1], buffer[pick]
+                    batch.append(buffer.pop())
+                else:
+                    batch.append(buffer.pop(0))
+                if len(batch) == batch_size:
+                    yield tuple(np.stack(values) for values in zip(*batch))
+                    batch = []
+        if shuffle:
+            np.random.shuffle(buffer)
+        batch.extend(buffer)
+        while len(batch) >= batch_size or (batch and not drop_last):
+            yield tuple(np.stack(values) for values in zip(*batch[:batch_size]))
+            batch = batch[batch_size:]
+
+    def close(self):
+        for data in self._files.values():
+            data.close()
+        self._files = {}
+
+
+def load_point_nums(filelist):
+    """Per-sample point counts ('data_num') of a filelist or shard index, read without loading the points."""
+    if filelist.endswith('.json'):
+        return np.array(load_shards(filelist)['data_num'])
+    dataset = H5Dataset(filelist, keys=('data_num',))
+    point_nums = np.concatenate([dataset.read(file_idx, 0, dataset.offsets[file_idx + 1] - dataset.offsets[file_idx])[0]
+                                 for file_idx in range(len(dataset.filenames))])
+    dataset.close()
+    return point_nums
+
+
+def get_bucket_boundaries(point_nums, bucket_num):
+    """Largest point count of each of bucket_num buckets holding about the same number of samples."""
+    point_nums_sorted = np.sort(point_nums)
+    quantile_indices = np.ceil(np.linspace(0, 1, bucket_num + 1)[1:] * (len(point_nums) - 1)).astype(np.int64)
+    return np.unique(point_nums_sorted[quantile_indices]).astype(np.int64)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of sample indices where every batch only holds samples of one point count bucket, so it can
+    be run at that bucket's point count (batch_point_num) instead of the largest one of the dataset.
+    Unless given, bucket boundaries are quantiles of the dataset's own point counts. Samples larger than
+    the last boundary go to the last bucket and get subsampled. last_batch is 'keep' or 'discard' for the
+    incomplete batch of each bucket.
+    """
+    def __init__(self, point_nums, batch_size, bucket_num=8, boundaries=None, shuffle=True, last_batch='keep'):
+        assert last_batch in ('keep', 'discard')
+        self.point_nums = np.asarray(point_nums)
+        self.batch_size = batch_size
+        self.boundaries = np.asarray(boundaries) if boundaries is not None \
+            else get_bucket_boundaries(self.point_nums, bucket_num)
+        self.bucket_ids = np.minimum(np.searchsorted(self.boundaries, self.point_nums), len(self.boundaries) - 1)
+        self.shuffle = shuffle
+        self.last_batch = last_batch
+
+    def _batches(self):
+        batches = []
+        for bucket_id in range(len(self.boundaries)):
+            indices = np.flatnonzero(self.bucket_ids == bucket_id)
+            if self.shuffle:
+                np.random.shuffle(indices)
+            for begin in range(0, len(indices), self.batch_size):
+                batch = indices[begin:begin + self.batch_size]
+                if len(batch) == self.batch_size or self.last_batch == 'keep':
+                    batches.append(batch)
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        for batch in self._batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        bucket_sizes = np.bincount(self.bucket_ids, minlength=len(self.boundaries))
+        if self.last_batch == 'keep':
+            return int(np.sum((bucket_sizes + self.batch_size - 1) // self.batch_size))
+        return int(np.sum(bucket_sizes // self.batch_size))
+
+    def batch_point_num(self, batch):
+        return int(self.boundaries[self.bucket_ids[batch[0]]])
+
+    def padding_ratio(self):
+        """Fraction of the points run that are padding, with bucketing and with every sample at the maximum."""
+        sizes = self.boundaries[self.bucket_ids]
+        bucketed = 1 - np.sum(np.minimum(self.point_nums, sizes)) / np.sum(sizes)
+        unbucketed = 1 - np.sum(self.point_nums) / (len(self.point_nums) * np.max(self.point_nums))
+        return bucketed, unbucketed
+
+
+class Prefetcher(object):
+    """Iterate over producer(item) for every item, computed up to `depth` items ahead on `num_workers`
+    background threads. Results come back in order. With depth=0 items are produced on the calling thread.
+    """
+    def __init__(self, producer, items, depth=2, num_workers=1):
+        self.producer = producer
+        self.items = iter(items)
+        self.depth = depth
+        self.futures = collections.deque()
+        self.executor = ThreadPoolExecutor(num_workers) if depth > 0 else None
+        self._fill()
+
+    def _fill(self):
+        while len(self.futures) < self.depth:
+            try:
+                item = next(self.items)
+            except StopIteration:
+                return
+            self.futures.append(self.executor.submit(self.producer, item))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.executor is None:
+            return self.producer(next(self.items))
+        if not self.futures:
+            self.close()
+            raise StopIteration
+        result = self.futures.popleft().result()
+        self._fill()
+        return result
+
+    next = __next__
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -4,6 +4,18 @@ import numpy as np
 import mxnet as mx
 import mxnet.gluon.nn as nn
 
+# The CUDA kernels below are compiled the first time an operator is created on a gpu context,
+# keyed by device, so importing this module needs neither NVRTC nor a GPU.
+_cuda_kernels = {}
+
+def get_cuda_kernel(source, name, signature, ctx):
+    key = (name, ctx.device_type, ctx.device_id)
+    if key not in _cuda_kernels:
+        module = mx.rtc.CudaModule(source, exports=[name])
+        # keep the module alive together with the kernel handle
+        _cuda_kernels[key] = (module, module.get_kernel(name, signature))
+    return _cuda_kernels[key][1]
+
 # input: points(b, n, 3) idx(b, m)
 # output: out(b, m, 3)
 fwd_source = r'''
@@ -34,17 +46,29 @@ bwd_source = r'''
     }        
 '''
 
-fwd_module = mx.rtc.CudaModule(fwd_source, exports=['gatherpointKernel'])
-fwd_kernel = fwd_module.get_kernel("gatherpointKernel"
-                                        , "int b,int n,int m,const float * inp,const int * idx,float * out")
+fwd_signature = "int b,int n,int m,const float * inp,const int * idx,float * out"
+bwd_signature = "int b,int n,int m,const float * out_g,const int * idx,float * inp_g"
 
-bwd_module = mx.rtc.CudaModule(bwd_source, exports=['scatteraddpointKernel'])
-bwd_kernel = bwd_module.get_kernel("scatteraddpointKernel"
-                                        , "int b,int n,int m,const float * out_g,const int * idx,float * inp_g")
+# input: points(b, n, 3) idx(b, m)
+# output: out(b, m, 3)
+def gather_point_cpu(points, idx):
+    return points[np.arange(points.shape[0])[:, None], idx]
+
+# input: out_g(b, m, 3) idx(b, m), n
+# output: inp_g(b, n, 3)
+def scatter_add_point_cpu(out_g, idx, n):
+    B, M = idx.shape
+    inp_g = np.zeros((B * n, out_g.shape[-1]), dtype=out_g.dtype)
+    flat_idx = (np.arange(B)[:, None] * n + idx).reshape(-1)
+    np.add.at(inp_g, flat_idx, out_g.reshape(B * M, -1))
+    return inp_g.reshape(B, n, -1)
 
 class GatherPoint(mx.operator.CustomOp):
-    def __init__(self):
+    def __init__(self, ctx):
         super(GatherPoint, self).__init__()
+        if ctx.device_type == 'gpu':
+            self.fwd_kernel = get_cuda_kernel(fwd_source, 'gatherpointKernel', fwd_signature, ctx)
+            self.bwd_kernel = get_cuda_kernel(bwd_source, 'scatteraddpointKernel', bwd_signature, ctx)
 
     def forward(self, is_train, req, in_data, out_data, aux):
         if req[0] == "null":
@@ -53,18 +77,38 @@ class GatherPoint(mx.operator.CustomOp):
         idx = in_data[1] # idx
         B, N, _ = x.shape
         _, M = idx.shape
+
+        if x.context.device_type == 'cpu':
+            y = gather_point_cpu(x.asnumpy(), idx.asnumpy().astype(np.int64))
+            self.assign(out_data[0], req[0], mx.nd.array(y, ctx=x.context, dtype=np.float32))
+            return
+
         y = mx.nd.empty(shape=(B, M, 3), ctx = x.context, dtype=np.float32) # output
 
         # args, ctx, grid_shape, block_shape, shared_mem = 0
-        fwd_kernel.launch([B, N, M, x, idx, y], x.context, (2, 8, 1), (512, 1, 1))
+        self.fwd_kernel.launch([B, N, M, x, idx, y], x.context, (2, 8, 1), (512, 1, 1))
 
         self.assign(out_data[0], req[0], y)
 
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
-        dx = mx.nd.empty(shape=in_data[0].shape, ctx = x.context, dtype=np.float32)
-        
-        bwd_kernel.launch([B, N, M, out_grad[0], in_data[1], dx], in_data[0].context, (2, 8, 1), (512, 1, 1))
-        
+        self.assign(in_grad[1], req[1], 0)
+        if req[0] == "null":
+            return
+        x = in_data[0]
+        idx = in_data[1]
+        B, N, _ = x.shape
+        _, M = idx.shape
+
+        if x.context.device_type == 'cpu':
+            dx = scatter_add_point_cpu(out_grad[0].asnumpy(), idx.asnumpy().astype(np.int64), N)
+            self.assign(in_grad[0], req[0], mx.nd.array(dx, ctx=x.context, dtype=np.float32))
+            return
+
+        # scatteraddpointKernel accumulates with atomicAdd, so dx has to start from zero
+        dx = mx.nd.zeros(shape=(B, N, 3), ctx = x.context, dtype=np.float32)
+
+        self.bwd_kernel.launch([B, N, M, out_grad[0], idx, dx], x.context, (2, 8, 1), (512, 1, 1))
+
         self.assign(in_grad[0], req[0], dx)
 
 @mx.operator.register("GatherPoint")
@@ -86,7 +130,7 @@ class GatherPointProp(mx.operator.CustomOpProp):
         return in_type, [np.float32], []
 
     def create_operator(self, ctx, in_shapes, in_dtypes):
-        return GatherPoint()
+        return GatherPoint(ctx)
 
 
 # Input dataset: (b, n, 3), tmp: (b, n)
@@ -161,23 +205,59 @@ source = r'''
     }
 '''
 
-module = mx.rtc.CudaModule(source, exports=['farthestpointsamplingKernel'])
-kernel = module.get_kernel("farthestpointsamplingKernel", "int b,int n,int m,const float * dataset,float * temp,int * idxs")
+signature = "int b,int n,int m,const float * dataset,float * temp,int * idxs"
+
+# Input dataset: (b, n, 3)
+# Ouput idxs (b, m)
+# Same selection rule as farthestpointsamplingKernel (start from point 0, then repeatedly take
+# the point farthest from the selected set), vectorized over the batch. Each of the m steps is a
+# few passes over preallocated (b, n) buffers, so the cost stays O(b * n * m) without temporaries.
+def farthest_point_sampling_cpu(dataset, m):
+    B, N, _ = dataset.shape
+    idxs = np.zeros((B, m), dtype=np.int32)
+    if m <= 0 or N == 0:
+        return idxs
+    coords = [np.ascontiguousarray(dataset[:, :, c], dtype=np.float32) for c in range(3)]  # 3 x (b, n)
+    temp = np.full((B, N), np.inf, dtype=np.float32)
+    dist = np.empty((B, N), dtype=np.float32)
+    diff = np.empty((B, N), dtype=np.float32)
+    batch = np.arange(B)
+    old = np.zeros(B, dtype=np.int64)
+    for j in range(1, m):
+        for c in range(3):
+            np.subtract(coords[c], coords[c][batch, old][:, None], out=diff)
+            np.multiply(diff, diff, out=diff)
+            if c == 0:
+                dist[...] = diff
+            else:
+                dist += diff
+        np.minimum(temp, dist, out=temp)
+        old = np.argmax(temp, axis=1)
+        idxs[:, j] = old
+    return idxs
 
 class FarthestPointSampling(mx.operator.CustomOp):
-    def __init__(self, npoints):
+    def __init__(self, npoints, ctx):
         super(FarthestPointSampling, self).__init__()
         self.npoints = npoints
+        if ctx.device_type == 'gpu':
+            self.kernel = get_cuda_kernel(source, 'farthestpointsamplingKernel', signature, ctx)
     def forward(self, is_train, req, in_data, out_data, aux):
         if req[0] == "null":
             return
         x = in_data[0]  # input
         B, N, _ = x.shape
+
+        if x.context.device_type == 'cpu':
+            y = farthest_point_sampling_cpu(x.asnumpy(), self.npoints)
+            self.assign(out_data[0], req[0], mx.nd.array(y, ctx=x.context, dtype=np.int32))
+            return
+
         tmp = mx.nd.ones(shape=(B, N), ctx = x.context) * 1e10
         y = mx.nd.empty(shape=(B, self.npoints), ctx = x.context, dtype=np.int32) # output
 
         # args, ctx, grid_shape, block_shape, shared_mem = 0
-        kernel.launch([B, N, self.npoints, x, tmp, y], x.context, (32, 1, 1), (512, 1, 1))
+        self.kernel.launch([B, N, self.npoints, x, tmp, y], x.context, (32, 1, 1), (512, 1, 1))
 
         self.assign(out_data[0], req[0], y)
 
@@ -206,4 +286,4 @@ class FarthestPointSamplingProp(mx.operator.CustomOpProp):
         return in_type, [np.int32], []
 
     def create_operator(self, ctx, in_shapes, in_dtypes):
-        return FarthestPointSampling(self.npoints)
+        return FarthestPointSampling(self.npoints, ctx)
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import numpy as np
+import mxnet as mx
+from scipy.spatial import cKDTree
+
+# Input queries: (b, p, 3), points: (b, n, 3)
+# Output indices: (2, b, p, k), same layout as knn_indices_general
+# Neighbors are sorted by increasing distance, so dilation can still slice every D-th one.
+def knn_kdtree_cpu(queries, points, k):
+    B, P, _ = queries.shape
+    indices = np.empty((2, B, P, k), dtype=np.float32)
+    indices[0] = np.arange(B, dtype=np.float32).reshape(-1, 1, 1)
+    for i in range(B):
+        tree = cKDTree(points[i])
+        _, point_indices = tree.query(queries[i], k=k, workers=-1)
+        indices[1, i] = np.reshape(point_indices, (P, k))
+    return indices
+
+class KnnKDTree(mx.operator.CustomOp):
+    def __init__(self, k):
+        super(KnnKDTree, self).__init__()
+        self.k = k
+
+    def forward(self, is_train, req, in_data, out_data, aux):
+        if req[0] == "null":
+            return
+        queries = in_data[0]
+        points = in_data[1]
+        y = knn_kdtree_cpu(queries.asnumpy(), points.asnumpy(), self.k)
+        self.assign(out_data[0], req[0], mx.nd.array(y, ctx=queries.context, dtype=np.float32))
+
+    def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+        self.assign(in_grad[0], req[0], 0)
+        self.assign(in_grad[1], req[1], 0)
+
+@mx.operator.register("KnnKDTree")
+class KnnKDTreeProp(mx.operator.CustomOpProp):
+    def __init__(self, k=1):
+        super(KnnKDTreeProp, self).__init__(need_top_grad=False)
+
+        self.k = int(k)
+
+    def list_arguments(self):
+        return ['queries', 'points']
+
+    def list_outputs(self):
+        return ['output']
+
+    def infer_shape(self, in_shape):
+        output_shape = (2, in_shape[0][0], in_shape[0][1], self.k)
+        return in_shape, [output_shape], []
+
+    def infer_type(self, in_type):
+        return in_type, [np.float32], []
+
+    def create_operator(self, ctx, in_shapes, in_dtypes):
+        return KnnKDTree(self.k)
@@ -0,0 +1,86 @@
+# coding: utf-8
+'''Run a training script as N data-parallel worker processes on this machine, with a dist_sync kvstore.
+
+python launch_local.py -n 4 python pointcnn_cls.py
+
+Starts the kvstore scheduler and servers and the workers on 127.0.0.1. Every worker creates its kvstore
+with mx.kv.create('dist_sync') (pointcnn_cls.py does when setting.kvstore is None) and gets its rank from it.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+
+
+def get_free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# Environment of every process of the job. OpenMP threads are split between the workers so that they do not
+# oversubscribe the cores, unless OMP_NUM_THREADS is already set.
+def get_env(role, num_workers, num_servers, port, threads):
+    env = dict(os.environ)
+    env.update({'DMLC_ROLE': role, 'DMLC_PS_ROOT_URI': '127.0.0.1', 'DMLC_PS_ROOT_PORT': str(port),
+                'DMLC_NUM_WORKER': str(num_workers), 'DMLC_NUM_SERVER': str(num_servers)})
+    if role == 'worker':
+        env.setdefault('OMP_NUM_THREADS', str(threads))
+    else:
+        env['OMP_NUM_THREADS'] = '1'
+    return env
+
+
+# Runs command in num_workers worker processes and returns the first non-zero exit code of a worker, or 0.
+# The scheduler and servers are mxnet processes that serve the kvstore from `import mxnet` until the workers
+# finalize it. When a worker fails the others would wait for it at the next dist_sync barrier forever, so the
+# whole job is terminated as soon as one does.
+def launch(command, num_workers, num_servers=1, threads=None, poll_interval=0.5):
+    port = get_free_port()
+    threads = threads or max((os.cpu_count() or 1) // num_workers, 1)
+    services = [subprocess.Popen([sys.executable, '-c', 'import mxnet'],
+                                 env=get_env(role, num_workers, num_servers, port, threads))
+                for role in ['scheduler'] + ['server'] * num_servers]
+    workers = [subprocess.Popen(command, env=get_env('worker', num_workers, num_servers, port, threads))
+               for _ in range(num_workers)]
+    code = 0
+    try:
+        while True:
+            codes = [worker.poll() for worker in workers]
+            code = next((c for c in codes if c is not None and c != 0), 0)
+            if code != 0 or all(c is not None for c in codes):
+                break
+            time.sleep(poll_interval)
+    finally:
+        for process in workers + services:
+            if process.poll() is None:
+                process.terminate()
+        for process in workers + services:
+            process.wait()
+    return code
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', '-n', help='Number of worker processes', type=int, required=True)
+    parser.add_argument('--num_servers', '-s', help='Number of kvstore server processes', type=int, default=1)
+    parser.add_argument('--threads', help='OpenMP threads per worker, the cores divided by the workers if not given',
+                        type=int)
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Command every worker runs')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error('no command to launch')
+    sys.exit(launch(args.command, args.num_workers, args.num_servers, args.threads))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,12 @@
 # coding: utf-8
 
+import os
+import re
+import sys
+import time
+import collections
+
+import numpy as np
 import mxnet as mx
 
 @mx.init.register
@@ -16,4 +23,147 @@ def get_shape(x):
         return x.shape
     elif isinstance(x, mx.symbol.Symbol):
         _,x_shape,_=x.infer_shape_partial()
-        return x_shape[0] 
\ No newline at end of file
+        return x_shape[0] 
+
+# Contexts from names like 'cpu(0)' or 'gpu(1)', gpu(0) when there is a GPU and cpu(0) otherwise if none are given
+def get_contexts(names=None):
+    if not names:
+        return [mx.gpu(0) if mx.context.num_gpus() > 0 else mx.cpu(0)]
+    contexts = []
+    for name in names:
+        match = re.match(r'^\s*(cpu|gpu)\s*\(\s*(\d+)\s*\)\s*$', name)
+        if match is None:
+            raise ValueError('Unknown context: {}'.format(name))
+        contexts.append(mx.Context(match.group(1), int(match.group(2))))
+    return contexts
+
+# A worker of a dist kvstore that raises would wait for the other workers in the kvstore finalization at exit,
+# and they for its gradients, so uncaught exceptions end the process right away and launch_local.py stops the job
+def exit_on_exception():
+    def excepthook(*exc_info):
+        sys.__excepthook__(*exc_info)
+        sys.stderr.flush()
+        os._exit(1)
+    sys.excepthook = excepthook
+
+# Value of a child block's parameter inside hybrid_forward, for blocks computing with it through other operators
+def get_param(F, param, like):
+    if F is mx.sym:
+        return param.var()
+    return param.data(like.context)
+
+# Opt-in per-stage profiling. Blocks mark their sub-stages with `with profile_stage(name) as stage:` and
+# pass the stage output through stage.add. Nothing is recorded unless a StageProfiler is active, and
+# hybridized graphs only run the hooks once while being traced, so disabled profiling costs nothing per step.
+_active_profiler = None
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, output):
+        return output
+
+_null_stage = _NullStage()
+
+def profile_stage(name):
+    if _active_profiler is None:
+        return _null_stage
+    return _Stage(_active_profiler, name)
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.outputs = []
+
+    def __enter__(self):
+        self.profiler.path.append(self.name)
+        self.path = '/'.join(self.profiler.path)
+        mx.nd.waitall()
+        self.task = mx.profiler.Task(self.profiler.domain, self.path) if self.profiler.trace_file else None
+        if self.task is not None:
+            self.task.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        mx.nd.waitall()
+        elapsed = time.time() - self.start
+        if self.task is not None:
+            self.task.stop()
+        self.profiler.path.pop()
+        # stages traced into a symbol have no run time of their own
+        if not any(isinstance(output, mx.symbol.Symbol) for output in self.outputs):
+            self.profiler.record(self.path, elapsed, self.outputs)
+        return False
+
+    def add(self, output):
+        self.outputs.append(output)
+        return output
+
+class StageProfiler(object):
+    """Wall time and output size of every stage marked with profile_stage, per nesting path such as
+    'xconv2/x_trans/transpose', over imperative (non-hybridized) runs. The engine is synchronized around
+    every stage, so times are exact but the profiled run is slower than a normal one. With trace_file set,
+    mx.profiler records operators too and stages appear as tasks of the 'PointCNN' domain in the Chrome
+    trace it writes.
+    """
+    def __init__(self, trace_file=None):
+        self.trace_file = trace_file
+        self.domain = mx.profiler.Domain('PointCNN') if trace_file else None
+        self.path = []
+        self.records = collections.OrderedDict()  # path -> [calls, seconds, output bytes, output shape]
+
+    def __enter__(self):
+        global _active_profiler
+        if self.trace_file:
+            mx.profiler.set_config(profile_all=True, aggregate_stats=True, filename=self.trace_file)
+            mx.profiler.set_state('run')
+        _active_profiler = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active_profiler
+        _active_profiler = None
+        if self.trace_file:
+            mx.nd.waitall()
+            mx.profiler.set_state('stop')
+            mx.profiler.dump()
+        return False
+
+    def record(self, path, elapsed, outputs):
+        record = self.records.setdefault(path, [0, 0.0, 0, None])
+        record[0] += 1
+        record[1] += elapsed
+        arrays = [output for output in outputs if isinstance(output, mx.nd.NDArray)]
+        if arrays:
+            record[2] = sum(array.size * np.dtype(array.dtype).itemsize for array in arrays)
+            record[3] = arrays[0].shape
+
+    def summary(self):
+        top_level_total = sum(record[1] for path, record in self.records.items() if '/' not in path) or 1.0
+        lines = ['%-40s %6s %10s %9s %7s %10s  %s' % ('stage', 'calls', 'total ms', 'mean ms', 'share', 'output MB',
+                                                      'output shape')]
+        for path in sorted(self.records, key=lambda path: path.split('/')):
+            calls, total, output_bytes, shape = self.records[path]
+            lines.append('%-40s %6d %10.2f %9.3f %6.1f%% %10.2f  %s' % (
+                path, calls, total * 1000, total * 1000 / calls, total * 100 / top_level_total,
+                output_bytes / 1e6, shape if shape is not None else ''))
+
+        # the same stage summed over all layers, e.g. every knn, every transpose or every xconv
+        by_name = collections.OrderedDict()
+        for path, (calls, total, _, _) in self.records.items():
+            if '/' in path:
+                name_record = by_name.setdefault(re.sub(r'\d+$', '', path.split('/')[-1]), [0, 0.0])
+                name_record[0] += calls
+                name_record[1] += total
+        lines.append('')
+        lines.append('%-40s %6s %10s %9s %7s' % ('stage (all layers)', 'calls', 'total ms', 'mean ms', 'share'))
+        for name, (calls, total) in sorted(by_name.items(), key=lambda item: -item[1][1]):
+            lines.append('%-40s %6d %10.2f %9.3f %6.1f%%' % (name, calls, total * 1000, total * 1000 / calls,
+                                                             total * 100 / top_level_total))
+        return '\n'.join(lines)
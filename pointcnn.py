@@ -3,9 +3,7 @@
 import numpy as np
 
 import math
-import random
-
-from transforms3d.euler import euler2mat
+import collections
 
 import mxnet as mx
 from mxnet import nd
@@ -14,72 +12,151 @@ import mxnet.gluon as gluon
 import mxnet.gluon.nn as nn
 from mxnet.gluon.data import Dataset, DataLoader
 
-from mxutils import MyConstant, get_shape
+from mxutils import MyConstant, get_shape, get_param, profile_stage
 from fpsop import *
+from knnop import *
+from voxelop import *
+
+KNN_BACKENDS = ('dense', 'kdtree')
+# how xconv layers with P != -1 pick their P queries among the points of the previous layer
+SAMPLING_METHODS = ('slice', 'fps', 'curvature', 'voxel', 'random')
 
 # the returned indices will be used by gather_nd
-def get_indices(batch_size, sample_num, point_num, random_sample=True):
+# shape is (2, batch_size, sample_num), a numpy array, or an int32 NDArray generated directly on ctx if given
+# samples with fewer points than sample_num are drawn with replacement, the others without
+def get_indices(batch_size, sample_num, point_num, random_sample=True, ctx=None):
     if not isinstance(point_num, np.ndarray):
         point_nums = np.full((batch_size), point_num)
     else:
         point_nums = point_num
 
-    indices = []
-    for i in range(batch_size):
-        pt_num = point_nums[i]
-        if random_sample:
-            choices = np.random.choice(pt_num, sample_num, replace=(pt_num < sample_num))
-        else:
-            choices = np.arange(sample_num) % pt_num
-        choices = np.expand_dims(choices, axis=0)
-        choices_2d = np.concatenate((np.full_like(choices, i), choices), axis=0)
-        indices.append(choices_2d)
-    return np.stack(indices, axis=1)
+    if ctx is not None:
+        return get_indices_nd(batch_size, sample_num, point_nums, random_sample, ctx)
+
+    if random_sample:
+        # with replacement: uniform in [0, pt_num)
+        choices = np.floor(np.random.rand(batch_size, sample_num) * point_nums[:, None]).astype(np.int64)
+        # without replacement: the first sample_num entries of a random permutation of [0, pt_num)
+        no_replace = point_nums >= sample_num
+        if np.any(no_replace):
+            pt_nums = point_nums[no_replace]
+            keys = np.random.rand(len(pt_nums), np.max(pt_nums))
+            keys[np.arange(keys.shape[1]) >= pt_nums[:, None]] = np.inf
+            choices[no_replace] = np.argsort(keys, axis=1)[:, :sample_num]
+    else:
+        choices = np.arange(sample_num)[None, :] % point_nums[:, None]
+    batch_indices = np.broadcast_to(np.arange(batch_size)[:, None], (batch_size, sample_num))
+    return np.stack((batch_indices, choices), axis=0)
+
+def get_indices_nd(batch_size, sample_num, point_nums, random_sample, ctx):
+    max_point_num = int(np.max(point_nums))
+    point_nums = nd.array(np.reshape(point_nums, (-1, 1)), ctx=ctx)  # (B, 1)
+    if random_sample:
+        choices = nd.floor(nd.broadcast_mul(nd.random.uniform(shape=(batch_size, sample_num), ctx=ctx), point_nums))
+        if sample_num <= max_point_num:
+            keys = nd.random.uniform(shape=(batch_size, max_point_num), ctx=ctx)
+            padding = nd.broadcast_greater_equal(nd.arange(max_point_num, ctx=ctx).reshape((1, -1)), point_nums)
+            permutation = nd.topk(keys + 2 * padding, axis=1, k=sample_num, ret_typ='indices', is_ascend=True)
+            no_replace = nd.broadcast_to(point_nums >= sample_num, (batch_size, sample_num))
+            choices = nd.where(no_replace, permutation, choices)
+    else:
+        choices = nd.broadcast_mod(nd.arange(sample_num, ctx=ctx).reshape((1, -1)), point_nums)
+    batch_indices = nd.broadcast_to(nd.arange(batch_size, ctx=ctx).reshape((-1, 1)), (batch_size, sample_num))
+    return nd.stack(batch_indices, choices, axis=0).astype(np.int32)
 
-def gauss_clip(mu, sigma, clip):
-    v = random.gauss(mu, sigma)
-    v = max(min(v, mu + clip * sigma), mu - clip * sigma)
-    return v
+def gauss_clip(mu, sigma, clip, size=None):
+    v = np.random.normal(mu, sigma, size)
+    return np.clip(v, mu - clip * sigma, mu + clip * sigma)
 
-def uniform(bound):
-    return bound * (2 * random.random() - 1)
+def uniform(bound, size=None):
+    return bound * (2 * np.random.random(size) - 1)
 
-def scaling_factor(scaling_param, method):
+def scaling_factor(scaling_param, method, size=None):
     try:
         scaling_list = list(scaling_param)
-        return random.choice(scaling_list)
-    except:
+        return np.random.choice(scaling_list, size)
+    except TypeError:
         if method == 'g':
-            return gauss_clip(1.0, scaling_param, 3)
+            return gauss_clip(1.0, scaling_param, 3, size)
         elif method == 'u':
-            return 1.0 + uniform(scaling_param)
+            return 1.0 + uniform(scaling_param, size)
 
-def rotation_angle(rotation_param, method):
+def rotation_angle(rotation_param, method, size=None):
     try:
         rotation_list = list(rotation_param)
-        return random.choice(rotation_list)
-    except:
+        return np.random.choice(rotation_list, size)
+    except TypeError:
         if method == 'g':
-            return gauss_clip(0.0, rotation_param, 3)
+            return gauss_clip(0.0, rotation_param, 3, size)
         elif method == 'u':
-            return uniform(rotation_param)
-
-def get_xforms(xform_num, rotation_range=(0, 0, 0, 'u'), scaling_range=(0.0, 0.0, 0.0, 'u'), order='rxyz'):
-    xforms = np.empty(shape=(xform_num, 3, 3))
-    rotations = np.empty(shape=(xform_num, 3, 3))
-    for i in range(xform_num):
-        rx = rotation_angle(rotation_range[0], rotation_range[3])
-        ry = rotation_angle(rotation_range[1], rotation_range[3])
-        rz = rotation_angle(rotation_range[2], rotation_range[3])
-        rotation = euler2mat(rx, ry, rz, order)
-
-        sx = scaling_factor(scaling_range[0], scaling_range[3])
-        sy = scaling_factor(scaling_range[1], scaling_range[3])
-        sz = scaling_factor(scaling_range[2], scaling_range[3])
-        scaling = np.diag([sx, sy, sz])
-
-        xforms[i, :] = scaling * rotation
-        rotations[i, :] = rotation
+            return uniform(rotation_param, size)
+
+# axis sequences of transforms3d.euler: (firstaxis, parity, repetition, frame) of every axes string
+_NEXT_AXIS = [1, 2, 0, 1]
+
+_AXES2TUPLE = {
+    'sxyz': (0, 0, 0, 0), 'sxyx': (0, 0, 1, 0), 'sxzy': (0, 1, 0, 0),
+    'sxzx': (0, 1, 1, 0), 'syzx': (1, 0, 0, 0), 'syzy': (1, 0, 1, 0),
+    'syxz': (1, 1, 0, 0), 'syxy': (1, 1, 1, 0), 'szxy': (2, 0, 0, 0),
+    'szxz': (2, 0, 1, 0), 'szyx': (2, 1, 0, 0), 'szyz': (2, 1, 1, 0),
+    'rzyx': (0, 0, 0, 1), 'rxyx': (0, 0, 1, 1), 'ryzx': (0, 1, 0, 1),
+    'rxzx': (0, 1, 1, 1), 'rxzy': (1, 0, 0, 1), 'ryzy': (1, 0, 1, 1),
+    'rzxy': (1, 1, 0, 1), 'ryxy': (1, 1, 1, 1), 'ryxz': (2, 0, 0, 1),
+    'rzxz': (2, 0, 1, 1), 'rxyz': (2, 1, 0, 1), 'rzyz': (2, 1, 1, 1)}
+
+# batched transforms3d.euler.euler2mat, angles are arrays of shape (n,)
+# return shape is (n, 3, 3)
+def euler2mat_batch(ai, aj, ak, axes='sxyz'):
+    firstaxis, parity, repetition, frame = _AXES2TUPLE[axes]
+    i = firstaxis
+    j = _NEXT_AXIS[i + parity]
+    k = _NEXT_AXIS[i - parity + 1]
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        ai, aj, ak = -ai, -aj, -ak
+    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+    M = np.empty((len(ai), 3, 3))
+    if repetition:
+        M[:, i, i] = cj
+        M[:, i, j] = sj * si
+        M[:, i, k] = sj * ci
+        M[:, j, i] = sj * sk
+        M[:, j, j] = -cj * ss + cc
+        M[:, j, k] = -cj * cs - sc
+        M[:, k, i] = -sj * ck
+        M[:, k, j] = cj * sc + cs
+        M[:, k, k] = cj * cc - ss
+    else:
+        M[:, i, i] = cj * ck
+        M[:, i, j] = sj * sc - cs
+        M[:, i, k] = sj * cc + ss
+        M[:, j, i] = cj * sk
+        M[:, j, j] = sj * ss + cc
+        M[:, j, k] = sj * cs - sc
+        M[:, k, i] = -sj
+        M[:, k, j] = cj * si
+        M[:, k, k] = cj * ci
+    return M
+
+# returns numpy arrays, or NDArrays on ctx ready to be passed to augment if ctx is given
+def get_xforms(xform_num, rotation_range=(0, 0, 0, 'u'), scaling_range=(0.0, 0.0, 0.0, 'u'), order='rxyz', ctx=None):
+    rx = rotation_angle(rotation_range[0], rotation_range[3], xform_num)
+    ry = rotation_angle(rotation_range[1], rotation_range[3], xform_num)
+    rz = rotation_angle(rotation_range[2], rotation_range[3], xform_num)
+    rotations = euler2mat_batch(rx, ry, rz, order)
+
+    sx = scaling_factor(scaling_range[0], scaling_range[3], xform_num)
+    sy = scaling_factor(scaling_range[1], scaling_range[3], xform_num)
+    sz = scaling_factor(scaling_range[2], scaling_range[3], xform_num)
+    scaling = np.stack([sx, sy, sz], axis=1)[:, :, None] * np.eye(3)  # (xform_num, 3, 3) diagonal
+
+    xforms = np.matmul(scaling, rotations)
+    if ctx is not None:
+        return nd.array(xforms, ctx=ctx), nd.array(rotations, ctx=ctx)
     return xforms, rotations
 
 def augment(points, xforms, r=None):
@@ -91,58 +168,61 @@ def augment(points, xforms, r=None):
     jitter_clipped = nd.clip(jitter_data, -5 * r, 5 * r, name='jitter_clipped')
     return points_xformed + jitter_clipped
 
+# Symmetric 3x3 matrices are passed as their diagonal (a, e, i) and off-diagonal (b, f, c) entries,
+# both (N, P, 3), so that batches of them need no (N, P, 3, 3) tensor
 # a b c
-# d e f
-# g h i
-# a(ei − fh) − b(di − fg) + c(dh − eg)
-def compute_determinant(A):
-    return A[..., 0, 0] * (A[..., 1, 1] * A[..., 2, 2] - A[..., 1, 2] * A[..., 2, 1])            - A[..., 0, 1] * (A[..., 1, 0] * A[..., 2, 2] - A[..., 1, 2] * A[..., 2, 0])            + A[..., 0, 2] * (A[..., 1, 0] * A[..., 2, 1] - A[..., 1, 1] * A[..., 2, 0])
-
-# A shape is (N, P, 3, 3)
+# b e f
+# c f i
+# a(ei − f²) − b(bi − fc) + c(bf − ec)
+def compute_determinant(F, diag, off):
+    a, e, i = [F.slice_axis(diag, axis=-1, begin=j, end=j + 1) for j in range(3)]
+    b, f, c = [F.slice_axis(off, axis=-1, begin=j, end=j + 1) for j in range(3)]
+    return F.reshape(a * (e * i - f * f) - b * (b * i - f * c) + c * (b * f - e * c), (0, 0))  # (N, P)
+
+# Closed form eigenvalues of symmetric 3x3 matrices, for the whole batch at once
+# diag and off shape is (N, P, 3)
 # return shape is (N, P, 3)
-def compute_eigenvals(A):
-    A_11 = A[:, :, 0, 0]  # (N, P)
-    A_12 = A[:, :, 0, 1]
-    A_13 = A[:, :, 0, 2]
-    A_22 = A[:, :, 1, 1]
-    A_23 = A[:, :, 1, 2]
-    A_33 = A[:, :, 2, 2]
-    I = nd.eye(3)
-    p1 = nd.square(A_12) + nd.square(A_13) + nd.square(A_23)  # (N, P)
-    q = (A_11 + A_22 + A_33) / 3  # (N, P)
-    p2 = nd.square(A_11 - q) + nd.square(A_22 - q) + nd.square(A_33 - q) + 2 * p1  # (N, P)
-    p = nd.sqrt(p2 / 6) + 1e-8  # (N, P)
-    N = A.shape[0]
-    q_4d = nd.reshape(q, (N, -1, 1, 1))  # (N, P, 1, 1)
-    p_4d = nd.reshape(p, (N, -1, 1, 1))
-    B = (1 / p_4d) * (A - q_4d * I)  # (N, P, 3, 3)
-    r = nd.clip(compute_determinant(B) / 2, -1, 1)  # (N, P)
-    phi = nd.arccos(r) / 3  # (N, P)
-    eig1 = q + 2 * p * nd.cos(phi)  # (N, P)
-    eig3 = q + 2 * p * nd.cos(phi + (2 * math.pi / 3))
+def compute_eigenvals(F, diag, off):
+    p1 = F.sum(F.square(off), axis=-1)  # (N, P)
+    q = F.mean(diag, axis=-1)  # (N, P)
+    diag_shifted = F.broadcast_sub(diag, F.expand_dims(q, axis=-1))  # (N, P, 3)
+    p2 = F.sum(F.square(diag_shifted), axis=-1) + 2 * p1  # (N, P)
+    p = F.sqrt(p2 / 6) + 1e-8  # (N, P)
+    p_3d = F.expand_dims(p, axis=-1)
+    r = F.clip(compute_determinant(F, F.broadcast_div(diag_shifted, p_3d), F.broadcast_div(off, p_3d)) / 2, -1, 1)
+    phi = F.arccos(r) / 3  # (N, P)
+    eig1 = q + 2 * p * F.cos(phi)  # (N, P)
+    eig3 = q + 2 * p * F.cos(phi + (2 * math.pi / 3))
     eig2 = 3 * q - eig1 - eig3
-    return nd.abs(nd.stack([eig1, eig2, eig3], axis=2)) # (N, P, 3)
+    return F.abs(F.stack(eig1, eig2, eig3, axis=2)) # (N, P, 3)
 
-# P shape is (N, P, 3), N shape is (N, P, K, 3)
+# nn_pts shape is (N, P, K, 3)
 # return shape is (N, P)
-def compute_curvature(nn_pts):
-    nn_pts_mean = nd.mean(nn_pts, axis=2, keepdims=True)  # (N, P, 1, 3)
-    nn_pts_demean = nn_pts - nn_pts_mean  # (N, P, K, 3)
-    nn_pts_NPK31 = nd.expand_dims(nn_pts_demean, axis=-1)
-    covariance_matrix = nd.batch_dot(nn_pts_NPK31, nn_pts_NPK31, transpose_b=True)  # (N, P, K, 3, 3)
-    covariance_matrix_mean = nd.mean(covariance_matrix, axis=2, keepdims=False)  # (N, P, 3, 3)
-    eigvals = compute_eigenvals(covariance_matrix_mean)  # (N, P, 3)
-    curvature = nd.min(eigvals, axis=-1) / (nd.sum(eigvals, axis=-1) + 1e-8)
+# The covariance of each neighborhood is E[x x^T] - E[x] E[x]^T, from first and second moments of (N, P, K, 3)
+# products, without the (N, P, K, 3, 3) outer products. Coordinates are taken relative to the first neighbor
+# so that the difference does not cancel out in float32.
+def compute_curvature(F, nn_pts):
+    nn_pts_local = F.broadcast_sub(nn_pts, F.slice_axis(nn_pts, axis=2, begin=0, end=1))  # (N, P, K, 3)
+    nn_pts_rolled = F.concat(F.slice_axis(nn_pts_local, axis=-1, begin=1, end=3),
+                             F.slice_axis(nn_pts_local, axis=-1, begin=0, end=1), dim=-1)  # y, z, x
+    mean = F.mean(nn_pts_local, axis=2)  # (N, P, 3)
+    mean_rolled = F.concat(F.slice_axis(mean, axis=-1, begin=1, end=3),
+                           F.slice_axis(mean, axis=-1, begin=0, end=1), dim=-1)
+    diag = F.mean(F.square(nn_pts_local), axis=2) - F.square(mean)  # xx, yy, zz
+    off = F.mean(nn_pts_local * nn_pts_rolled, axis=2) - mean * mean_rolled  # xy, yz, zx
+    eigvals = compute_eigenvals(F, diag, off)  # (N, P, 3)
+    curvature = F.min(eigvals, axis=-1) / (F.sum(eigvals, axis=-1) + 1e-8)
     return curvature
 
-def curvature_based_sample(nn_pts, k):
-    curvature = compute_curvature(nn_pts)
-    point_indices = nd.topk(curvature, axis=-1, k=k, ret_typ='indices')
+# nn_pts shape is (N, P, K, 3), the neighbors of every point of a cloud
+# return shape is (2, N, k), gather_nd indices of the k points of highest curvature
+def curvature_based_sample(F, nn_pts, k):
+    curvature = compute_curvature(F, nn_pts)
+    point_indices = F.topk(curvature, axis=-1, k=k, ret_typ='indices')  # (N, k)
 
-    pts_shape = nn_pts.shape
-    batch_size = pts_shape[0]
-    batch_indices = nd.tile(nd.reshape(nd.arange(batch_size), (-1, 1, 1)), (1, k, 1))
-    indices = nd.concat(batch_indices, nd.expand_dims(point_indices, axis=2), dim=2)
+    batch_size = get_shape(nn_pts)[0]
+    batch_indices = F.reshape(get_batch_indices(F, batch_size, k, 1, point_indices), (1, batch_size, k))
+    indices = F.concat(batch_indices, F.expand_dims(point_indices, axis=0), dim=0)
     return indices
 
 class BN(nn.HybridBlock):
@@ -150,9 +230,12 @@ class BN(nn.HybridBlock):
         super(BN, self).__init__()
         self.bn = nn.BatchNorm(axis=1, use_global_stats=False)
     def hybrid_forward(self, F ,x):
-        x = F.transpose(x, axes=(0,3,1,2))
-        x = self.bn(x)
-        x = F.transpose(x, axes=(0,2,3,1))
+        with profile_stage('transpose') as stage:
+            x = stage.add(F.transpose(x, axes=(0,3,1,2)))
+        with profile_stage('bn') as stage:
+            x = stage.add(self.bn(x))
+        with profile_stage('transpose') as stage:
+            x = stage.add(F.transpose(x, axes=(0,2,3,1)))
         return x
     
 class SepCONV(nn.HybridBlock):
@@ -171,33 +254,61 @@ class SepCONV(nn.HybridBlock):
         if with_bn:
             self.bn = nn.BatchNorm(axis=1, use_global_stats=False)
     def hybrid_forward(self, F ,x):
-        x = F.transpose(x, axes=(0,3,1,2))
-        x = self.net(x)
-        if self.act is not None:
-            x = self.elu(x)
-        if self.with_bn:
-            x = self.bn(x)
-        x = F.transpose(x, axes=(0,2,3,1))
+        with profile_stage('transpose') as stage:
+            x = stage.add(F.transpose(x, axes=(0,3,1,2)))
+        with profile_stage('sepconv') as stage:
+            x = self.net(x)
+            if self.act is not None:
+                x = self.elu(x)
+            if self.with_bn:
+                x = self.bn(x)
+            stage.add(x)
+        with profile_stage('transpose') as stage:
+            x = stage.add(F.transpose(x, axes=(0,2,3,1)))
         return x
 
 class CONV(nn.HybridBlock):
-    def __init__(self, output, kernel_size, with_bn=True, activation='elu'):
+    def __init__(self, output, kernel_size, with_bn=True, activation='elu', channel_last=False, in_channels=0):
         super(CONV, self).__init__()
-        self.net = nn.Conv2D(channels=output, kernel_size=kernel_size, strides=(1,1), use_bias=False if with_bn else True)
+        self.net = nn.Conv2D(channels=output, kernel_size=kernel_size, strides=(1,1), use_bias=False if with_bn else True,
+                             in_channels=in_channels)
+        self.output = output
         self.act = activation
         self.with_bn = with_bn
+        self.channel_last = channel_last
+        # the weight is never given an input to infer its shape from in channel-last mode
+        assert not channel_last or (kernel_size[0] == 1 and in_channels > 0), \
+            'channel-last CONV needs a (1, K) kernel and in_channels'
         if activation is not None:
             self.elu = nn.ELU()
         if with_bn:
-            self.bn = nn.BatchNorm(axis=1, use_global_stats=False)
+            self.bn = nn.BatchNorm(axis=-1 if channel_last else 1, use_global_stats=False)
     def hybrid_forward(self, F ,x):
-        x = F.transpose(x, axes=(0,3,1,2))
-        x = self.net(x)
-        if self.act is not None:
-            x = self.elu(x)
-        if self.with_bn:
-            x = self.bn(x)
-        x = F.transpose(x, axes=(0,2,3,1))
+        if self.channel_last:
+            # A (1, K) kernel spans a whole row of K neighbors, so the convolution is a FullyConnected over the
+            # flattened (K, C) rows with the (output, C, 1, K) weight permuted to (output, K * C)
+            with profile_stage('conv') as stage:
+                weight = F.reshape(F.transpose(get_param(F, self.net.weight, x), axes=(0,2,3,1)), (0, -1))
+                bias = get_param(F, self.net.bias, x) if self.net.bias is not None else None
+                x = F.FullyConnected(F.reshape(x, (0, 0, 1, -1)), weight, bias, num_hidden=self.output,
+                                     no_bias=bias is None, flatten=False)  # (N, P, 1, output)
+                if self.act is not None:
+                    x = self.elu(x)
+                if self.with_bn:
+                    x = self.bn(x)
+                stage.add(x)
+            return x
+        with profile_stage('transpose') as stage:
+            x = stage.add(F.transpose(x, axes=(0,3,1,2)))
+        with profile_stage('conv') as stage:
+            x = self.net(x)
+            if self.act is not None:
+                x = self.elu(x)
+            if self.with_bn:
+                x = self.bn(x)
+            stage.add(x)
+        with profile_stage('transpose') as stage:
+            x = stage.add(F.transpose(x, axes=(0,2,3,1)))
         return x        
 
 class DENSE(nn.HybridBlock):
@@ -260,48 +371,172 @@ class batch_distance_matrix_general(nn.HybridBlock):
         D = F.broadcast_add(F.broadcast_sub(r_A, 2 * m), F.transpose(r_B, axes=(0, 2, 1)))
         return D
 
+# Index grids of gather_nd and take indices depend only on shapes. NDArray grids are built once per shape and
+# context and reused, keeping the most recently used INDEX_GRID_CACHE_SIZE of them so that runs over many point
+# counts do not hold a grid for each; symbols get a broadcast of a small arange, which the graph builds once.
+INDEX_GRID_CACHE_SIZE = 16
+_index_grids = collections.OrderedDict()
+
+def _cached_grid(F, key, like, build):
+    if F is mx.sym:
+        return build(F)
+    key = key + (like.context,)
+    if key in _index_grids:
+        _index_grids.move_to_end(key)
+    else:
+        _index_grids[key] = build(nd).as_in_context(like.context)
+        if len(_index_grids) > INDEX_GRID_CACHE_SIZE:
+            _index_grids.popitem(last=False)
+    return _index_grids[key]
+
+# (1, N, P, K) batch index of every neighbor, the first channel of (2, N, P, K) gather_nd indices
+def get_batch_indices(F, batch_size, point_num, k, like):
+    def build(F):
+        return F.broadcast_to(F.reshape(F.arange(batch_size), (1, -1, 1, 1)), (1, batch_size, point_num, k))
+    return _cached_grid(F, ('batch', batch_size, point_num, k), like, build)
+
+# (N, P, 1) int32 offsets of the rows of K neighbors in the flattened (N * P * K) point channel, exact past
+# the 2^24 positions float32 can address
+def get_row_offsets(F, batch_size, point_num, k, like):
+    def build(F):
+        return F.reshape(F.arange(batch_size * point_num, dtype='int32') * k, (batch_size, point_num, 1))
+    return _cached_grid(F, ('rows', batch_size, point_num, k), like, build)
+
+# Pick (query_tile, point_tile) so that one tile keeps about max_bytes of distances and topk
+# temporaries alive. Whole rows of points are preferred since they need no top-k merging.
+def get_knn_tile_size(batch_size, query_num, point_num, max_bytes, bytes_per_distance=12):
+    max_distances = max(max_bytes // (bytes_per_distance * batch_size), 1)
+    point_tile = min(point_num, max_distances)
+    query_tile = max(min(query_num, max_distances // point_tile), 1)
+    return query_tile, point_tile
+
+# Brute-force knn over (query_tile, point_tile) blocks with a running top-k per query, so that at most
+# (N, query_tile, point_tile) distances exist at a time instead of the full (N, P_A, P_B) matrix.
+# return shape is (N, P_A, K), sorted by increasing distance
+def knn_tiled(F, distance_matrix, queries, points, k, batch_size, query_num, point_num, tile_size):
+    query_tile, point_tile = tile_size
+    query_tile = min(query_tile or query_num, query_num)
+    point_tile = min(point_tile or point_num, point_num)
+    tiles = []
+    for q_begin in range(0, query_num, query_tile):
+        q_end = min(q_begin + query_tile, query_num)
+        qrs = F.slice_axis(queries, axis=1, begin=q_begin, end=q_end)
+        best_d, best_i = None, None
+        for p_begin in range(0, point_num, point_tile):
+            p_end = min(p_begin + point_tile, point_num)
+            pts = F.slice_axis(points, axis=1, begin=p_begin, end=p_end)
+            D = distance_matrix(qrs, pts)
+            d, i = F.topk(-D, axis=-1, k=min(k, p_end - p_begin), ret_typ='both', is_ascend=False)
+            i = i + p_begin
+            if best_d is None:
+                best_d, best_i = d, i
+                continue
+            # merge the running top-k of the previous blocks with the top-k of this block
+            candidate_num = min(k, p_begin) + min(k, p_end - p_begin)
+            d = F.concat(best_d, d, dim=-1)  # (N, q, candidate_num)
+            i = F.concat(best_i, i, dim=-1)
+            # int32 positions in the flattened candidates, float32 would round them past 2^24
+            best_d, selected = F.topk(d, axis=-1, k=min(k, p_end), ret_typ='both', is_ascend=False, dtype='int32')
+            offsets = F.reshape(F.arange(batch_size * (q_end - q_begin), dtype='int32') * candidate_num,
+                                (batch_size, -1, 1))
+            best_i = F.take(F.reshape(i, (-1,)), F.broadcast_add(selected, offsets))
+        tiles.append(best_i)
+    return tiles[0] if len(tiles) == 1 else F.concat(*tiles, dim=1)
+
+# mx topk always returns its result sorted, so `sort` is kept only for parity with the TF version
+# backend 'dense' runs topk over the full distance matrix, 'kdtree' queries a per-cloud KD-tree on CPU
+# the dense backend is tiled when tile_size=(query_tile, point_tile) or a max_bytes budget is given
 # return shape is (2, N, P, K)
 class knn_indices(nn.HybridBlock):
-    def __init__(self, k, sort=True):
+    def __init__(self, k, sort=True, backend='dense', tile_size=None, max_bytes=None):
         super(knn_indices, self).__init__()
+        if backend not in KNN_BACKENDS:
+            raise ValueError('Unknown knn backend: {}'.format(backend))
         self.k = k
         self.sort = sort
+        self.backend = backend
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
         self.batch_distance_matrix = batch_distance_matrix()
+        self.batch_distance_matrix_general = batch_distance_matrix_general()
     def hybrid_forward(self, F, points):
+        if self.backend == 'kdtree':
+            return F.Custom(points, points, op_type='KnnKDTree', k=self.k)
+
         points_shape = get_shape(points)
         batch_size = points_shape[0]
         point_num = points_shape[1]
 
-        D = self.batch_distance_matrix(points)
-
-        sorttype = False if self.sort else None
-        point_indices = F.topk(-D, axis=-1, k=self.k, ret_typ='indices', is_ascend=sorttype)
-        batch_indices = F.tile(F.reshape(F.arange(batch_size), (1, -1, 1, 1)), (1, 1, point_num, self.k))
+        tile_size = self.tile_size
+        if self.max_bytes is not None:
+            tile_size = get_knn_tile_size(batch_size, point_num, point_num, self.max_bytes)
+        if tile_size is not None:
+            point_indices = knn_tiled(F, self.batch_distance_matrix_general, points, points, self.k,
+                                      batch_size, point_num, point_num, tile_size)
+        else:
+            D = self.batch_distance_matrix(points)
+            point_indices = F.topk(-D, axis=-1, k=self.k, ret_typ='indices', is_ascend=False)
+        batch_indices = get_batch_indices(F, batch_size, point_num, self.k, point_indices)
         indices = F.concat(batch_indices, F.expand_dims(point_indices, axis=0), dim=0)
         return indices
 
 # return shape is (2, N, P, K)
 class knn_indices_general(nn.HybridBlock):
-    def __init__(self, k, sort=True):
+    def __init__(self, k, sort=True, backend='dense', tile_size=None, max_bytes=None):
         super(knn_indices_general, self).__init__()
+        if backend not in KNN_BACKENDS:
+            raise ValueError('Unknown knn backend: {}'.format(backend))
         self.k = k
         self.sort = sort
+        self.backend = backend
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
         self.batch_distance_matrix_general = batch_distance_matrix_general()
     def hybrid_forward(self, F, queries, points):
+        if self.backend == 'kdtree':
+            return F.Custom(queries, points, op_type='KnnKDTree', k=self.k)
+
         queries_shape = get_shape(queries)
         batch_size = queries_shape[0]
         point_num = queries_shape[1]
 
-        D = self.batch_distance_matrix_general(queries, points)
-
-        sorttype = False if self.sort else True
-        point_indices = F.topk(-D, axis=-1, k=self.k, ret_typ='indices', is_ascend=sorttype)  # (N, P, K)
-        batch_indices = F.tile(F.reshape(F.arange(batch_size), (1, -1, 1, 1)), (1, 1, point_num, self.k))
+        tile_size = self.tile_size
+        if self.max_bytes is not None:
+            tile_size = get_knn_tile_size(batch_size, point_num, get_shape(points)[1], self.max_bytes)
+        if tile_size is not None:
+            point_indices = knn_tiled(F, self.batch_distance_matrix_general, queries, points, self.k,
+                                      batch_size, point_num, get_shape(points)[1], tile_size)  # (N, P, K)
+        else:
+            D = self.batch_distance_matrix_general(queries, points)
+            point_indices = F.topk(-D, axis=-1, k=self.k, ret_typ='indices', is_ascend=False)  # (N, P, K)
+        batch_indices = get_batch_indices(F, batch_size, point_num, self.k, point_indices)
         indices = F.concat(batch_indices, F.expand_dims(point_indices, axis=0), dim=0)
         return indices
 
+# points shape is (N, P_in, 3)
+# return shape is (N, P, 3), P distinct points of each cloud drawn uniformly at random, anew on every forward
+def random_sample(F, points, P):
+    batch_size, point_num = get_shape(points)[:2]
+    keys = F.random.uniform(shape=(batch_size, point_num))
+    point_indices = F.topk(keys, axis=-1, k=P, ret_typ='indices')  # (N, P)
+    batch_indices = F.reshape(get_batch_indices(F, batch_size, P, 1, point_indices), (1, batch_size, P))
+    return F.gather_nd(points, F.concat(batch_indices, F.expand_dims(point_indices, axis=0), dim=0))
+
+# points shape is (N, P_in, 3)
+# return shape is (N, P, 3), the P points of highest curvature, estimated from the k nearest neighbors of each
+class curvature_sampler(nn.HybridBlock):
+    def __init__(self, k, P, backend='dense', tile_size=None, max_bytes=None):
+        super(curvature_sampler, self).__init__()
+        self.P = P
+        self.knn_indices = knn_indices(k, True, backend, tile_size, max_bytes)
+    def hybrid_forward(self, F, points):
+        nn_pts = F.gather_nd(points, self.knn_indices(points))  # (N, P_in, k, 3)
+        return F.gather_nd(points, curvature_based_sample(F, nn_pts, self.P))
+
 # indices is (2, N, P, K)
-# return shape is (2, N, P, K)
+# return shape is (2, N, P, K), the neighbors of every query reordered by sorting_method
+# The batch channel of indices is the same for all K neighbors of a query, so sorting only permutes the point
+# channel within each row of K: the permutation from topk is applied with one take over the flattened rows.
 class sort_points(nn.HybridBlock):
     def __init__(self, sorting_method):
         super(sort_points, self).__init__()
@@ -331,23 +566,22 @@ class sort_points(nn.HybridBlock):
         if self.sorting_method.startswith('c'):
             nn_pts_min = F.min(nn_pts, axis=2, keepdims=True)
             nn_pts_max = F.max(nn_pts, axis=2, keepdims=True)
-            nn_pts_normalized = (nn_pts - nn_pts_min) / (nn_pts_max - nn_pts_min + self.epsilon)  # (N, P, K, 3)
-            scaling_const = F.Variable('scaling_factors', shape=(1,3), init=MyConstant(scaling_factors))
-            scaling_const = F.BlockGrad(scaling_const)
-            scaling = F.reshape(scaling_const, (1,1,1,3))
-            sorting_data = F.sum(nn_pts_normalized * scaling, axis=-1, keepdims=False)  # (N, P, K)
+            nn_pts_normalized = F.broadcast_div(F.broadcast_sub(nn_pts, nn_pts_min),
+                                                nn_pts_max - nn_pts_min + self.epsilon)  # (N, P, K, 3)
+            sorting_data = sum(F.slice_axis(nn_pts_normalized, axis=-1, begin=i, end=i + 1) * factor
+                               for i, factor in enumerate(self.scaling_factors))
+            sorting_data = F.reshape(sorting_data, (0, 0, 0))  # (N, P, K)
         elif self.sorting_method == 'l2':
             nn_pts_center = F.mean(nn_pts, axis=2, keepdims=True)  # (N, P, 1, 3)
             nn_pts_local = F.broadcast_sub(nn_pts, nn_pts_center)  # (N, P, K, 3)
-            #sorting_data = norm(nn_pts_local, axis=-1, keep_dims=False)  # (N, P, K)
-            sorting_data = F.sqrt(F.sum(F.multiply(nn_pts_local, nn_pts_local),axis=-1, keepdims=False))
+            # squared distances sort like distances
+            sorting_data = F.sum(F.square(nn_pts_local), axis=-1, keepdims=False)  # (N, P, K)
 
-        k_indices = F.topk(sorting_data, axis=-1, k=k, ret_typ='indices', is_ascend=False)  # (N, P, K)
-        batch_indices = F.tile(F.reshape(F.arange(batch_size), (1,-1, 1, 1)), (1, 1, point_num, k))
-        point_indices = F.tile(F.reshape(F.arange(point_num), (1, 1, -1, 1)), (1, batch_size, 1, k))
-        k_indices_4d = F.expand_dims(k_indices, axis=0)
-        sorting_indices = F.concat(batch_indices, point_indices, k_indices_4d, dim=0)  # (N, P, K, 3)
-        return F.transpose(F.gather_nd(F.transpose(indices, axes=(1,2,3,0)), sorting_indices), axes=(3,0,1,2))
+        k_indices = F.topk(sorting_data, axis=-1, k=k, ret_typ='indices', is_ascend=False, dtype='int32')  # (N, P, K)
+        k_indices = F.broadcast_add(k_indices, get_row_offsets(F, batch_size, point_num, k, k_indices))
+        point_indices = F.slice_axis(indices, axis=0, begin=1, end=2)  # (1, N, P, K)
+        sorted_point_indices = F.take(F.reshape(point_indices, (-1,)), F.expand_dims(k_indices, axis=0))
+        return F.concat(F.slice_axis(indices, axis=0, begin=0, end=1), sorted_point_indices, dim=0)
 
 def top_1_accuracy(probs, labels, weights=None,is_partial=None, num=None):
     P = probs.asnumpy()
@@ -374,7 +608,8 @@ def custom_metric(labels, preds):
 
 class xconv(nn.HybridBlock):
     def __init__(self, K, D, P, C, C_pts_fts, C_prev, with_X_transformation, depth_multiplier
-                 ,sorting_method=None, **kwargs):
+                 ,sorting_method=None, knn_backend='dense', knn_tile_size=None, knn_max_bytes=None, channel_last=False,
+                 **kwargs):
         super(xconv, self).__init__(**kwargs)
         self.K = K
         self.D = D
@@ -385,9 +620,11 @@ class xconv(nn.HybridBlock):
         self.sorting_method = sorting_method
         with self.name_scope():
             if self.D == 1:
-                self.knn_indices_general = knn_indices_general(self.K, False)
+                self.knn_indices_general = knn_indices_general(self.K, False, knn_backend,
+                                                               knn_tile_size, knn_max_bytes)
             else:
-                self.knn_indices_general = knn_indices_general(self.K * self.D, True)
+                self.knn_indices_general = knn_indices_general(self.K * self.D, True, knn_backend,
+                                                               knn_tile_size, knn_max_bytes)
             if self.sorting_method is not None:
                 self.sort_points = sort_points(self.sorting_method)
             self.fts_from_pts = nn.HybridSequential()
@@ -399,47 +636,60 @@ class xconv(nn.HybridBlock):
 
             self.x_trans = nn.HybridSequential()
             self.x_trans.add(
-                CONV(K*K, (1, K), with_bn=False),
+                CONV(K*K, (1, K), with_bn=False, channel_last=channel_last, in_channels=3),
                 DENSE(K*K, with_bn=False),
                 DENSE(K*K, with_bn=False, activation=None)
             )
             
             self.sconv0 = SepCONV(C_pts_fts+C_prev, C, (1,K), depth_multiplier)
         
-    def hybrid_forward(self, F, pts, fts, qrs):
-        if self.D == 1:
-            indices = self.knn_indices_general(qrs, pts)
-        else:
-            indices_dilated = self.knn_indices_general(qrs, pts)
-            indices = F.slice(indices_dilated, begin=(0,0,0,0), end=(None,None,None,None), step=(None,None,None,self.D))
+    # shared_indices: optional (2, N, P, K') neighbors of qrs in pts sorted by distance, with K' >= K * D,
+    # computed once by the caller for several layers working on the same (pts, qrs)
+    def hybrid_forward(self, F, pts, fts, qrs, shared_indices=None):
+        with profile_stage('knn') as stage:
+            if shared_indices is not None:
+                indices = F.slice(shared_indices, begin=(0,0,0,0), end=(None,None,None,self.K * self.D), step=(None,None,None,self.D))
+            elif self.D == 1:
+                indices = self.knn_indices_general(qrs, pts)
+            else:
+                indices_dilated = self.knn_indices_general(qrs, pts)
+                indices = F.slice(indices_dilated, begin=(0,0,0,0), end=(None,None,None,None), step=(None,None,None,self.D))
+            stage.add(indices)
 
         P = get_shape(qrs)[1] if self.P == -1 else self.P
         if self.sorting_method is not None:
-            indices = self.sort_points(pts, indices)
+            with profile_stage('sort_points') as stage:
+                indices = stage.add(self.sort_points(pts, indices))
 
-        nn_pts = F.gather_nd(pts, indices)  # (N, P, K, 3)
-        nn_pts_center = F.expand_dims(qrs, axis=2)  # (N, P, 1, 3)
-        nn_pts_local = F.broadcast_sub(nn_pts, nn_pts_center)  # (N, P, K, 3)
+        with profile_stage('gather') as stage:
+            nn_pts = F.gather_nd(pts, indices)  # (N, P, K, 3)
+            nn_pts_center = F.expand_dims(qrs, axis=2)  # (N, P, 1, 3)
+            nn_pts_local = stage.add(F.broadcast_sub(nn_pts, nn_pts_center))  # (N, P, K, 3)
         
         # Prepare features to be transformed
-        nn_pts_local_bn = self.bn0(nn_pts_local)
-        nn_fts_from_pts = self.fts_from_pts(nn_pts_local_bn)
+        with profile_stage('fts_from_pts') as stage:
+            nn_pts_local_bn = self.bn0(nn_pts_local)
+            nn_fts_from_pts = stage.add(self.fts_from_pts(nn_pts_local_bn))
 
         if fts is None:
             nn_fts_input = nn_fts_from_pts
         else:
-            nn_fts_from_prev = F.gather_nd(fts, indices)
-            nn_fts_input = F.concat(nn_fts_from_pts, nn_fts_from_prev, dim=-1)
+            with profile_stage('gather_fts') as stage:
+                nn_fts_from_prev = F.gather_nd(fts, indices)
+                nn_fts_input = stage.add(F.concat(nn_fts_from_pts, nn_fts_from_prev, dim=-1))
 
         if self.with_X_transformation:
             ######################## X-transformation #########################
-            X_2 = self.x_trans(nn_pts_local_bn)
-            X = F.reshape(X_2, (-1, P, self.K, self.K))
-            fts_X = F.linalg.gemm2(X, nn_fts_input)
+            with profile_stage('x_trans') as stage:
+                X_2 = self.x_trans(nn_pts_local_bn)
+                X = stage.add(F.reshape(X_2, (-1, P, self.K, self.K)))
+            with profile_stage('x_gemm') as stage:
+                fts_X = stage.add(F.linalg.gemm2(X, nn_fts_input))
             ###################################################################
         else:
             fts_X = nn_fts_input
-        fts = self.sconv0(fts_X)
+        with profile_stage('sconv') as stage:
+            fts = stage.add(self.sconv0(fts_X))
         return F.squeeze(fts, axis=2)
 
 class PointCNN(nn.HybridBlock):
@@ -452,13 +702,51 @@ class PointCNN(nn.HybridBlock):
         self.sorting_method = setting.sorting_method
         self.num_class = setting.num_class
         self.with_fps = setting.with_fps
+        # one method for every layer or one per layer, following with_fps when not given
+        sampling = setting.sampling or ('fps' if self.with_fps else 'slice')
+        self.sampling = [sampling] * len(self.xconv_params) if isinstance(sampling, str) else list(sampling)
+        for method in self.sampling:
+            if method not in SAMPLING_METHODS:
+                raise ValueError('Unknown sampling method: {}'.format(method))
+        self.knn_backend = setting.knn_backend or 'dense'
+        self.knn_tile_size = setting.knn_tile_size
+        self.knn_max_bytes = setting.knn_max_bytes
+        self.share_knn = setting.share_knn if setting.share_knn is not None else True
+        self.channel_last = setting.channel_last or False
         self.task = task
         self.with_feature = with_feature
 
+        # xconv layers with P == -1 use the input cloud as queries, so several of them can work on the
+        # same (pts, qrs) pair. Each such group runs knn once at its largest K * D.
+        knn_groups = collections.OrderedDict()
+        qrs_source = 0  # 0 is the input cloud, i + 1 the queries sampled by layer i
+        for layer_idx, layer_param in enumerate(self.xconv_params):
+            pts_source = qrs_source
+            qrs_source = 0 if layer_param[2] == -1 else layer_idx + 1
+            knn_groups.setdefault((pts_source, qrs_source), []).append(layer_idx)
+        shared_knn_groups = [g for g in knn_groups.values() if len(g) > 1] if self.share_knn else []
+        self.shared_knn_layers = {layer_idx: group_idx for group_idx, layer_indices in enumerate(shared_knn_groups)
+                                  for layer_idx in layer_indices}
+
         with self.name_scope():
             if with_feature:
                 C_fts = self.xconv_params[0][-1] // 2
                 self.dense0 = DENSE(C_fts)
+            self.shared_knns = nn.HybridSequential()
+            for layer_indices in shared_knn_groups:
+                k = max(self.xconv_params[layer_idx][0] * self.xconv_params[layer_idx][1]
+                        for layer_idx in layer_indices)
+                self.shared_knns.add(knn_indices_general(k, True, self.knn_backend,
+                                                         self.knn_tile_size, self.knn_max_bytes))
+
+            self.curvature_samplers = nn.HybridSequential()
+            self.curvature_sampler_layers = {}
+            for layer_idx, (K, _, P, _) in enumerate(self.xconv_params):
+                if P != -1 and self.sampling[layer_idx] == 'curvature':
+                    self.curvature_sampler_layers[layer_idx] = len(self.curvature_samplers)
+                    self.curvature_samplers.add(curvature_sampler(K, P, self.knn_backend, self.knn_tile_size,
+                                                              self.knn_max_bytes))
+
             self.xconvs = nn.HybridSequential()
             for layer_idx, layer_param in enumerate(self.xconv_params):
                 K, D, P, C = layer_param
@@ -472,7 +760,8 @@ class PointCNN(nn.HybridBlock):
                     C_pts_fts = C_prev // 4
                     depth_multiplier = math.ceil(C / C_prev)
                 xc = xconv(K, D, P, C, C_pts_fts, C_prev, self.with_X_transformation,
-                           depth_multiplier, self.sorting_method, prefix="xconv{}_".format(layer_idx) )
+                           depth_multiplier, self.sorting_method, self.knn_backend, self.knn_tile_size, self.knn_max_bytes,
+                           self.channel_last, prefix="xconv{}_".format(layer_idx) )
                 self.xconvs.add(xc)
                 
             if self.task == 'segmentation':
@@ -486,7 +775,8 @@ class PointCNN(nn.HybridBlock):
                     C_pts_fts = C_prev // 4
                     depth_multiplier = 1
                     xdc = xconv(K, D, P, C, C_pts_fts, C_prev, self.with_X_transformation,
-                                depth_multiplier, self.sorting_method, prefix="xdconv{}_".format(layer_idx) )
+                                depth_multiplier, self.sorting_method, self.knn_backend, self.knn_tile_size,
+                                self.knn_max_bytes, self.channel_last, prefix="xdconv{}_".format(layer_idx) )
                     self.xdconvs.add(xdc)
                     self.fuse_fcs.add(DENSE(C))
 
@@ -502,6 +792,7 @@ class PointCNN(nn.HybridBlock):
         if self.with_feature and features is not None:
             features = self.dense0(features)
         layer_fts = [features]
+        shared_indices = {}
 
         for layer_idx, layer_param in enumerate(self.xconv_params):
             P = layer_param[2]
@@ -509,15 +800,34 @@ class PointCNN(nn.HybridBlock):
             fts = layer_fts[-1]
             if P == -1:
                 qrs = points
-            else:
-                if self.with_fps:
+            elif self.sampling[layer_idx] == 'fps':
+                with profile_stage('fps{}'.format(layer_idx)) as stage:
                     tmp = F.Custom(pts, name='fps{}_'.format(layer_idx), op_type='FarthestPointSampling', npoints=P)
-                    qrs = F.Custom(*[pts, tmp], name='gather{}_'.format(layer_idx), op_type='GatherPoint')
-                else:
-                    qrs = F.slice(pts, (0, 0, 0), (None, P, None))  # (N, P, 3)
+                    qrs = stage.add(F.Custom(*[pts, tmp], name='gather{}_'.format(layer_idx), op_type='GatherPoint'))
+            elif self.sampling[layer_idx] == 'voxel':
+                with profile_stage('voxel{}'.format(layer_idx)) as stage:
+                    tmp = F.Custom(pts, name='voxel{}_'.format(layer_idx), op_type='VoxelGridSampling', npoints=P)
+                    qrs = stage.add(F.Custom(*[pts, tmp], name='gather{}_'.format(layer_idx), op_type='GatherPoint'))
+            elif self.sampling[layer_idx] == 'random':
+                with profile_stage('random{}'.format(layer_idx)) as stage:
+                    qrs = stage.add(random_sample(F, pts, P))
+            elif self.sampling[layer_idx] == 'curvature':
+                with profile_stage('curvature{}'.format(layer_idx)) as stage:
+                    qrs = stage.add(self.curvature_samplers[self.curvature_sampler_layers[layer_idx]](pts))  # (N, P, 3)
+            else:
+                qrs = F.slice(pts, (0, 0, 0), (None, P, None))  # (N, P, 3)
             layer_pts.append(qrs)
 
-            fts_xconv = self.xconvs[layer_idx](pts, fts, qrs)
+            if layer_idx in self.shared_knn_layers:
+                group_idx = self.shared_knn_layers[layer_idx]
+                if group_idx not in shared_indices:
+                    with profile_stage('shared_knn{}'.format(group_idx)) as stage:
+                        shared_indices[group_idx] = stage.add(self.shared_knns[group_idx](qrs, pts))
+                with profile_stage('xconv{}'.format(layer_idx)) as stage:
+                    fts_xconv = stage.add(self.xconvs[layer_idx](pts, fts, qrs, shared_indices[group_idx]))
+            else:
+                with profile_stage('xconv{}'.format(layer_idx)) as stage:
+                    fts_xconv = stage.add(self.xconvs[layer_idx](pts, fts, qrs))
             layer_fts.append(fts_xconv)
             
         if self.task == 'segmentation':
@@ -529,12 +839,15 @@ class PointCNN(nn.HybridBlock):
                 qrs = layer_pts[qrs_layer_idx + 1]
                 fts_qrs = layer_fts[qrs_layer_idx + 1]
                 
-                fts_xdconv = self.xdconvs[layer_idx](pts, fts, qrs)
-                fts_concat = F.concat(fts_xdconv, fts_qrs, dim=-1)
-                fts_fuse = self.fuse_fcs[layer_idx](fts_concat)
+                with profile_stage('xdconv{}'.format(layer_idx)) as stage:
+                    fts_xdconv = stage.add(self.xdconvs[layer_idx](pts, fts, qrs))
+                with profile_stage('fuse{}'.format(layer_idx)) as stage:
+                    fts_concat = F.concat(fts_xdconv, fts_qrs, dim=-1)
+                    fts_fuse = stage.add(self.fuse_fcs[layer_idx](fts_concat))
                 layer_pts.append(qrs)
                 layer_fts.append(fts_fuse)
-        logits = self.fcs(layer_fts[-1])
+        with profile_stage('fcs') as stage:
+            logits = stage.add(self.fcs(layer_fts[-1]))
 
         return logits
 
@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import os
+import gc
 os.environ['MXNET_CUDNN_AUTOTUNE_DEFAULT']='0'
 
 import math
@@ -13,136 +14,174 @@ logging.basicConfig(level=logging.INFO)
 import mxnet as mx
 from mxnet import nd
 import mxnet.gluon as gluon
-from mxutils import get_shape
+import mxnet.autograd as ag
+from mxutils import get_shape, get_contexts, exit_on_exception, StageProfiler, profile_stage
 
-from pointcnn import PointCNN, get_indices, get_xforms, augment, custom_metric, get_loss_sym
+from pointcnn import PointCNN, PointCNNLoss, get_indices, get_xforms, custom_metric, get_loss_sym
 
-from dotdict import DotDict
 import h5py
 import collections
 import data_utils
+import costmodel
 
-########################### Settings ###############################
-setting = DotDict()
-
-setting.num_class = 10
-
-setting.sample_num = 160
-
-setting.batch_size = 32
-
-setting.num_epochs = 2048
-
-setting.jitter = 0.01
-setting.jitter_val = 0.01
-
-setting.rotation_range = [0, math.pi / 18, 0, 'g']
-setting.rotation_range_val = [0, 0, 0, 'u']
-setting.order = 'rxyz'
-
-setting.scaling_range = [0.05, 0.05, 0.05, 'g']
-setting.scaling_range_val = [0, 0, 0, 'u']
-
-x = 2
-
-# K, D, P, C
-setting.xconv_params = [(8, 1, -1, 16 * x),
-                (8, 2, -1, 32 * x),
-                (8, 4, -1, 48 * x),
-                (12, 4, 120, 64 * x),
-                (12, 6, 120, 80 * x)]
-
-# C, dropout_rate
-setting.fc_params = [(64 * x, 0.0), (32 * x, 0.5)]
-
-setting.with_fps = False
-
-setting.data_dim = 3
-setting.with_X_transformation = True
-setting.sorting_method = None
-###################################################################
+from setting_mnist import setting
 
 data_train, label_train, data_val, label_val = data_utils.load_cls_train_val('./mnist/train_files.txt',
                             './mnist/test_files.txt')
 
-nd_iter = mx.io.NDArrayIter(data={'data': data_train}, label={'softmax_label': label_train}, batch_size=setting.batch_size)
-
+ctx = get_contexts(setting.contexts)
+kv = mx.kv.create(setting.kvstore or ('dist_sync' if 'DMLC_NUM_WORKER' in os.environ else 'local'))
+if 'dist' in kv.type:
+    exit_on_exception()
+
+if setting.memory_budget:
+    # the budget holds for every device, each of which runs its slice of the batch
+    sample_num_budget = setting.sample_num + setting.sample_num // 4
+    setting.batch_size = len(ctx) * costmodel.max_batch_size(setting, sample_num_budget, setting.memory_budget)
+    if setting.batch_size < len(ctx):
+        peak = costmodel.analyze(setting, 1, sample_num_budget)['training_peak_bytes']
+        raise ValueError('memory_budget of %.0fMB cannot hold one sample per device, which needs an estimated %.0fMB'
+                         % (setting.memory_budget / 1e6, peak / 1e6))
+    print('batch size for a %.0fMB budget: %d' % (setting.memory_budget / 1e6, setting.batch_size))
+if setting.batch_size % len(ctx) != 0:
+    raise ValueError('batch_size {} is not a multiple of the {} contexts'.format(setting.batch_size, len(ctx)))
+
+# every worker of a distributed kvstore trains on its own shard, and all of them run the same number of
+# steps per epoch since dist_sync waits for the gradients of every worker
+num_train_total = data_train.shape[0]
+data_train = data_train[kv.rank::kv.num_workers]
+label_train = label_train[kv.rank::kv.num_workers]
 
 num_train = data_train.shape[0]
 point_num = data_train.shape[1]
 
-batch_num_per_epoch = int(math.ceil(num_train / setting.batch_size))
+batch_num_per_epoch = int(math.ceil(num_train_total / (setting.batch_size * kv.num_workers)))
 batch_num = batch_num_per_epoch * setting.num_epochs
 batch_size_train = setting.batch_size
 
-ctx = [mx.gpu(0)]
 net = PointCNN(setting, 'classification', with_feature=False, prefix="PointCNN_")
 net.hybridize()
 
-sym_max_points = point_num
-
-var = mx.sym.var('data', shape=(batch_size_train // len(ctx), sym_max_points, 3))
-
-probs = net(var)
-probs_shape = get_shape(probs)
-label_var = mx.sym.var('softmax_label', shape=(batch_size_train // len(ctx), probs_shape[1]))
-
-loss = get_loss_sym(probs, label_var)
-
-mod = mx.mod.Module(loss, data_names=['data'], label_names=['softmax_label'], context=ctx)
-mod.bind(data_shapes=[('data',(batch_size_train, sym_max_points, 3))]
-         , label_shapes=[('softmax_label',(batch_size_train, probs_shape[1]))])
-mod.init_params(initializer=mx.init.Xavier(magnitude=2.))
-
-mod.init_optimizer(optimizer='sgd', optimizer_params={'learning_rate':0.01, 'momentum': 0.9})
-
-for i in range(400):
-    nd_iter.reset()
-    for ibatch, batch in enumerate(nd_iter):
-        t0 = time.time()
-
-        label = batch.label[0]
-        labels_2d = nd.expand_dims(label,axis=-1)
-        pts_fts = batch.data[0]
-        bs = pts_fts.shape[0]
-        points2 = nd.slice(pts_fts, begin=(0,0,0), end= (None, None, 3))
-        #features2 = nd.slice(pts_fts, begin=(0,0,3), end= (None, None, None))
-
-        offset = int(random.gauss(0, setting.sample_num // 8))
-        offset = max(offset, -setting.sample_num // 4)
-        offset = min(offset, setting.sample_num // 4)
-        sample_num_train = setting.sample_num + offset
-
-        indices = get_indices(batch_size_train, sample_num_train, point_num)
-        indices_nd = nd.array(indices, dtype=np.int32)
-        points_sampled = nd.gather_nd(points2, indices=indices_nd)
-        #features_sampled = nd.gather_nd(features2, indices=nd.transpose(indices_nd, (2, 0, 1)))
-
-        xforms_np, rotations_np = get_xforms(batch_size_train, rotation_range=setting.rotation_range, order=setting.order)
-        points_xformed = nd.batch_dot(points_sampled, nd.array(xforms_np), name='points_xformed')
-        points_augmented = augment(points_sampled, nd.array(xforms_np), setting.jitter)
-        features_augmented = None
-
-        var = mx.sym.var('data', shape=(batch_size_train // len(ctx), sample_num_train, 3))
+sample_num_min = setting.sample_num - setting.sample_num // 4
+sample_num_max = setting.sample_num + setting.sample_num // 4
+if setting.sample_num_buckets:
+    sample_num_keys = sorted(set(np.round(np.linspace(sample_num_min, sample_num_max, setting.sample_num_buckets)).astype(int)))
+else:
+    sample_num_keys = list(range(sample_num_min, sample_num_max + 1))
+
+# random number of points to train on, rounded up to the next bucket
+def get_sample_num_train():
+    offset = int(random.gauss(0, setting.sample_num // 8))
+    offset = max(offset, -setting.sample_num // 4)
+    offset = min(offset, setting.sample_num // 4)
+    sample_num_train = setting.sample_num + offset
+    return sample_num_keys[np.searchsorted(sample_num_keys, sample_num_train)]
+
+# the graph for each point number is built once and the module keeps one executor per bucket, on every
+# device, each binding batch_size_train // len(ctx) samples of the batch
+sym_cache = {}
+def sym_gen(sample_num):
+    if sample_num not in sym_cache:
+        var = mx.sym.var('data', shape=(batch_size_train // len(ctx), sample_num, 3))
         probs = net(var)
         probs_shape = get_shape(probs)
-        loss = get_loss_sym(probs, label_var)
-
-        labels_tile = nd.tile(labels_2d, (1, probs_shape[1]))
-        nb = mx.io.DataBatch(data=[points_sampled], label=[labels_tile], pad=nd_iter.getpad(), index=None)
-
-        mod._symbol = loss
-        mod.binded=False
-        mod.bind(data_shapes=[('data',(batch_size_train, sample_num_train,3))]
-                 , label_shapes=[('softmax_label',(batch_size_train, probs_shape[1]))], shared_module=mod)
+        label_var = mx.sym.var('softmax_label', shape=(batch_size_train // len(ctx), probs_shape[1]))
+        sym_cache[sample_num] = (get_loss_sym(probs, label_var), probs_shape[1])
+    return sym_cache[sample_num][0], ('data',), ('softmax_label',)
 
-        mod.forward(nb, is_train=True)
+def get_label_num(sample_num):
+    sym_gen(sample_num)
+    return sym_cache[sample_num][1]
 
-        value = custom_metric(nb.label[0], mod.get_outputs()[0])
-
-        mod.backward()
-        mod.update()
-
-        t1 = time.time()
-        print(ibatch, t1-t0 , value)
+mod = mx.mod.BucketingModule(sym_gen, default_bucket_key=sample_num_max, context=ctx)
+mod.bind(data_shapes=[('data',(batch_size_train, sample_num_max, 3))]
+         , label_shapes=[('softmax_label',(batch_size_train, get_label_num(sample_num_max)))])
+mod.init_params(initializer=mx.init.Xavier(magnitude=2.))
 
+# the module sums the gradients of the devices and workers through kv and rescales them by the global batch size
+mod.init_optimizer(kvstore=kv, optimizer='sgd', optimizer_params={'learning_rate':0.01, 'momentum': 0.9})
+
+# Runs on the prefetch threads with numpy only: picks the samples of one batch (wrapping around the end
+# of the epoch like NDArrayIter's padding), samples points from them and augments them.
+def prepare_batch(batch_idx):
+    sample_indices = np.arange(batch_idx * batch_size_train, (batch_idx + 1) * batch_size_train)
+    pad = max(sample_indices[-1] + 1 - num_train, 0)
+    sample_indices = sample_indices % num_train
+    points = data_train[sample_indices, :, :3]
+    label = label_train[sample_indices]
+
+    sample_num_train = get_sample_num_train()
+    indices = get_indices(batch_size_train, sample_num_train, point_num)
+    points_sampled = points[indices[0], indices[1]]
+
+    xforms, rotations = get_xforms(batch_size_train, rotation_range=setting.rotation_range,
+                                   scaling_range=setting.scaling_range, order=setting.order)
+    points_augmented = np.matmul(points_sampled, xforms)
+    jitter = np.clip(setting.jitter * np.random.randn(*points_augmented.shape), -5 * setting.jitter, 5 * setting.jitter)
+    points_augmented = (points_augmented + jitter).astype(np.float32)
+    return points_augmented, label, sample_num_train, pad
+
+def to_data_batch(batch):
+    points_augmented, label, sample_num_train, pad = batch
+    points_nd = nd.array(points_augmented)
+    labels_tile = nd.tile(nd.array(np.expand_dims(label, axis=-1)), (1, get_label_num(sample_num_train)))
+    return mx.io.DataBatch(data=[points_nd], label=[labels_tile], pad=pad, index=None,
+                           bucket_key=sample_num_train,
+                           provide_data=[mx.io.DataDesc('data', points_nd.shape)],
+                           provide_label=[mx.io.DataDesc('softmax_label', labels_tile.shape)])
+
+# Profiles a non-hybridized copy of the network with the initial parameters on real batches
+def profile(steps):
+    net_profile = PointCNN(setting, 'classification', with_feature=False, prefix="PointCNN_")
+    arg_params, aux_params = mod.get_params()
+    params = dict([('arg:%s' % k, v) for k, v in arg_params.items()] + [('aux:%s' % k, v) for k, v in aux_params.items()])
+    net_profile.collect_params().load_dict(params, ctx=ctx)
+    with StageProfiler(trace_file='%s_profile.json' % setting.model_prefix) as profiler:
+        for step in range(steps):
+            points_augmented, label, _, _ = prepare_batch(step % batch_num_per_epoch)
+            points_nd = nd.array(points_augmented, ctx=ctx[0])
+            with ag.record():
+                with profile_stage('forward') as stage:
+                    probs = stage.add(net_profile(points_nd))
+                labels_tile = nd.tile(nd.array(np.expand_dims(label, axis=-1), ctx=ctx[0]), (1, probs.shape[1]))
+                loss = PointCNNLoss(probs, labels_tile)
+            with profile_stage('backward') as stage:
+                loss.backward()
+    print(profiler.summary())
+
+if setting.profile_steps:
+    profile(setting.profile_steps)
+
+batch_indices = (batch_idx for i in range(400) for batch_idx in range(batch_num_per_epoch))
+prefetcher = data_utils.Prefetcher(prepare_batch, batch_indices, setting.prefetch_depth, setting.prefetch_workers)
+
+# double buffering: the next batch is taken from the pipeline while the engine still computes the current one,
+# and turned into NDArrays once it is done. t_wait is the time spent blocked on the pipeline.
+batch_num_train = batch_num_per_epoch * 400
+nb_next = to_data_batch(next(prefetcher))
+for step in range(batch_num_train):
+    t0 = time.time()
+    ibatch = step % batch_num_per_epoch
+    nb = nb_next
+
+    mod.forward(nb, is_train=True)
+    mod.backward()
+    mod.update()
+
+    t1 = time.time()
+    batch_next = next(prefetcher) if step + 1 < batch_num_train else None
+    t_wait = time.time() - t1
+
+    value = custom_metric(nb.label[0], mod.get_outputs()[0])
+    nb_next = to_data_batch(batch_next) if batch_next is not None else None
+
+    t_step = time.time() - t0
+    print(ibatch, t_step, value, 'data wait %.4f compute %.4f' % (t_wait, t_step - t_wait))
+    if ibatch == batch_num_per_epoch - 1 and kv.rank == 0:
+        mod.save_params('%s-%04d.params' % (setting.model_prefix, step // batch_num_per_epoch))
+prefetcher.close()
+
+# a dist kvstore finalizes with a barrier of all workers when it is freed, which deadlocks with the engine
+# shutdown of mxnet at exit if a worker gets there first, so the kvstore is freed before the script ends
+del mod, kv
+gc.collect()
@@ -0,0 +1,151 @@
+# coding: utf-8
+
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import mxnet as mx
+import mxnet.gluon as gluon
+
+from pointcnn import PointCNN, get_indices
+
+# Network bound to a fixed (batch_size, sample_num, 3) input, so it can be hybridized with static memory and
+# shapes. For classification, clouds of any size are sampled (or padded by repetition) to sample_num points.
+class Predictor(object):
+    def __init__(self, setting, params_file=None, batch_size=None, sample_num=None, ctx=mx.cpu(), random_sample=True,
+                 task='classification'):
+        self.batch_size = batch_size or setting.batch_size
+        self.sample_num = sample_num or setting.sample_num
+        self.num_class = setting.num_class
+        self.ctx = ctx
+        self.random_sample = random_sample
+
+        net = PointCNN(setting, task, with_feature=False, prefix="PointCNN_")
+        data = mx.sym.var('data', shape=(self.batch_size, self.sample_num, 3), dtype=np.float32)
+        probs = mx.sym.softmax(net(data), axis=-1)  # (N, P, num_class)
+        if task == 'classification':
+            probs = mx.sym.mean(probs, axis=1)  # (N, num_class)
+        self.symbol = probs
+        self.net = gluon.SymbolBlock(probs, data, params=net.collect_params())
+        if params_file is not None:
+            # checkpoints saved by the training Module keep their arg:/aux: prefixes, ParameterDict.load strips them
+            self.net.collect_params().load(params_file, ctx=ctx)
+        else:
+            self.net.collect_params().initialize(mx.init.Xavier(magnitude=2.), ctx=ctx)
+        self.net.hybridize(static_alloc=True, static_shape=True)
+
+    # points: (batch_size, sample_num, 3), returns the probabilities as an NDArray without waiting for them
+    def forward(self, points):
+        return self.net(mx.nd.array(points, ctx=self.ctx))
+
+    # clouds: list of (point_num_i, >=3) arrays, at most batch_size of them
+    def prepare(self, clouds):
+        assert 0 < len(clouds) <= self.batch_size
+        point_nums = np.ones((self.batch_size), dtype=np.int64)
+        point_nums[:len(clouds)] = [len(cloud) for cloud in clouds]
+        points = np.zeros((self.batch_size, np.max(point_nums), 3), dtype=np.float32)
+        for i, cloud in enumerate(clouds):
+            points[i, :len(cloud)] = cloud[:, :3]
+        indices = get_indices(self.batch_size, self.sample_num, point_nums, self.random_sample)
+        return points[indices[0], indices[1]]  # (batch_size, sample_num, 3)
+
+    # returns (len(clouds), num_class) class probabilities
+    def predict(self, clouds):
+        probs = self.forward(self.prepare(clouds)).asnumpy()
+        return probs[:len(clouds)]
+
+# Coalesces single-cloud requests into batches for a Predictor. A batch is run once it is full, or when
+# its oldest request has waited max_latency seconds.
+class DynamicBatcher(object):
+    def __init__(self, predictor, max_latency=0.01):
+        self.predictor = predictor
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # returns a Future resolving to the (num_class,) probabilities of the cloud
+    def submit(self, cloud):
+        future = Future()
+        self.requests.put((cloud, future, time.time()))
+        return future
+
+    def _run(self):
+        closing = False
+        while not closing:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = request[2] + self.max_latency
+            while len(batch) < self.predictor.batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+
+            try:
+                probs = self.predictor.predict([cloud for cloud, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), prob in zip(batch, probs):
+                future.set_result(prob)
+
+    # pending requests are still served before the worker exits
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params', '-p', help='Path to parameters saved by pointcnn_cls.py, random weights if not given')
+    parser.add_argument('--batch_size', '-b', help='Inference batch size', type=int, default=16)
+    parser.add_argument('--max_latency', '-l', help='Max time a request waits for its batch (ms)', type=float, default=10)
+    parser.add_argument('--requests', '-n', help='Number of requests to send', type=int, default=512)
+    parser.add_argument('--rate', '-r', help='Poisson arrival rate (requests/s), 0 sends them all at once', type=float, default=0)
+    parser.add_argument('--point_num_min', help='Min points per request cloud', type=int, default=80)
+    parser.add_argument('--point_num_max', help='Max points per request cloud', type=int, default=320)
+    args = parser.parse_args()
+
+    from setting_mnist import setting
+    predictor = Predictor(setting, args.params, batch_size=args.batch_size, ctx=mx.cpu())
+    predictor.predict([np.zeros((1, 3), dtype=np.float32)])  # warm up: allocates the static graph
+    batcher = DynamicBatcher(predictor, args.max_latency / 1000.0)
+
+    point_nums = np.random.randint(args.point_num_min, args.point_num_max + 1, size=args.requests)
+    clouds = [np.random.uniform(-1, 1, (n, 3)).astype(np.float32) for n in point_nums]
+
+    latencies = np.empty((args.requests))
+    def on_done(idx, t_submit):
+        return lambda future: latencies.__setitem__(idx, time.time() - t_submit)
+
+    t_start = time.time()
+    futures = []
+    for idx, cloud in enumerate(clouds):
+        if args.rate > 0:
+            time.sleep(np.random.exponential(1.0 / args.rate))
+        t_submit = time.time()
+        future = batcher.submit(cloud)
+        future.add_done_callback(on_done(idx, t_submit))
+        futures.append(future)
+    for future in futures:
+        future.result()
+    t_total = time.time() - t_start
+    batcher.close()
+
+    print('{} requests in {:.3f}s: {:.1f} requests/s, latency p50 {:.2f}ms p99 {:.2f}ms'.format(
+        args.requests, t_total, args.requests / t_total,
+        np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# coding: utf-8
+
+import json
+import time
+import argparse
+import collections
+
+import numpy as np
+import mxnet as mx
+import mxnet.gluon as gluon
+from mxnet.contrib.quantization import quantize_model_mkldnn
+
+import data_utils
+from pointcnn_infer import Predictor
+
+# Nodes kept in float32: knn works on raw coordinates, where int8 steps would reorder neighbors, and the
+# depthwise (1, K) convolutions of SepCONV have no faster int8 kernel on CPU.
+def get_excluded_sym_names(sym, exclude_depthwise=True):
+    excluded = []
+    for node in json.loads(sym.tojson())['nodes']:
+        if 'knn' in node['name'] or 'distance_matrix' in node['name']:
+            excluded.append(node['name'])
+        elif exclude_depthwise and node['op'] == 'Convolution' and node['attrs'].get('num_group', '1') != '1':
+            excluded.append(node['name'])
+    return excluded
+
+# Post-training int8 quantization of a Predictor's network, calibrated on calib_clouds. DENSE, CONV and SepCONV
+# layers, X-transformation MLP included, run through oneDNN int8 kernels. Returns the quantized symbol and
+# parameters, and switches the predictor to them.
+def quantize_predictor(predictor, calib_clouds, calib_mode='naive', exclude_depthwise=True):
+    arg_params = {}
+    aux_params = {}
+    aux_names = set(predictor.symbol.list_auxiliary_states())
+    for name, param in predictor.net.collect_params().items():
+        (aux_params if name in aux_names else arg_params)[name] = param.data(predictor.ctx)
+
+    batch_num = len(calib_clouds) // predictor.batch_size
+    calib_points = np.concatenate([predictor.prepare(calib_clouds[i * predictor.batch_size:(i + 1) * predictor.batch_size])
+                                   for i in range(batch_num)])
+    calib_data = mx.io.NDArrayIter(calib_points, batch_size=predictor.batch_size)
+    qsym, qarg_params, qaux_params = quantize_model_mkldnn(
+        predictor.symbol, arg_params, aux_params, data_names=('data',), label_names=(), ctx=mx.cpu(),
+        excluded_sym_names=get_excluded_sym_names(predictor.symbol, exclude_depthwise), calib_mode=calib_mode,
+        calib_data=calib_data, num_calib_examples=len(calib_points), quantized_dtype='auto')
+
+    data = mx.sym.var('data', shape=(predictor.batch_size, predictor.sample_num, 3), dtype=np.float32)
+    net = gluon.SymbolBlock(qsym, data)
+    params = dict([('arg:%s' % k, v) for k, v in qarg_params.items()] + [('aux:%s' % k, v) for k, v in qaux_params.items()])
+    net.collect_params().load_dict(params, ctx=predictor.ctx, cast_dtype=True, dtype_source='saved')
+    net.hybridize(static_alloc=True, static_shape=True)
+    predictor.symbol = qsym
+    predictor.net = net
+    return qsym, qarg_params, qaux_params
+
+# accuracy and timing of predictor on (points, labels), batch by batch
+def evaluate(predictor, points, labels):
+    clouds = list(points)
+    predictor.predict(clouds[:predictor.batch_size])  # warm up
+    probs = []
+    times = []
+    for begin in range(0, len(clouds), predictor.batch_size):
+        start = time.time()
+        probs.append(predictor.predict(clouds[begin:begin + predictor.batch_size]))
+        times.append(time.time() - start)
+    probs = np.concatenate(probs)
+    return dict(probs=probs, accuracy=float(np.mean(np.argmax(probs, axis=-1) == labels)),
+                latency=float(np.median(times)), throughput=len(clouds) / float(np.sum(times)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params', '-p', help='Path to parameters saved by pointcnn_cls.py', required=True)
+    parser.add_argument('--filelist', '-t', help='Path to test data filelist', default='./mnist/test_files.txt')
+    parser.add_argument('--filelist_calib', '-c', help='Path to calibration data filelist',
+                        default='./mnist/train_files.txt')
+    parser.add_argument('--calib_num', help='Number of calibration samples', type=int, default=512)
+    parser.add_argument('--calib_mode', help='naive (min/max) or entropy', default='naive')
+    parser.add_argument('--quantize_depthwise', help='Also quantize the depthwise convolutions', action='store_true')
+    parser.add_argument('--batch_size', '-b', help='Inference batch size', type=int, default=32)
+    parser.add_argument('--eval_num', '-n', help='Number of test samples to evaluate', type=int, default=1024)
+    parser.add_argument('--output', '-o', help='Prefix to save the quantized symbol and parameters')
+    args = parser.parse_args()
+    print(args)
+
+    from setting_mnist import setting
+    points, labels = data_utils.load_cls(args.filelist)
+    points, labels = points[:args.eval_num, :, :3], labels[:args.eval_num]
+    points_calib, _ = data_utils.load_cls(args.filelist_calib)
+    points_calib = points_calib[np.random.permutation(len(points_calib))[:args.calib_num], :, :3]
+
+    # the same points are sampled from each cloud by both networks
+    predictor = Predictor(setting, args.params, batch_size=args.batch_size, ctx=mx.cpu(), random_sample=False)
+    fp32 = evaluate(predictor, points, labels)
+    qsym, qarg_params, qaux_params = quantize_predictor(predictor, list(points_calib), args.calib_mode,
+                                                        not args.quantize_depthwise)
+    int8 = evaluate(predictor, points, labels)
+    if args.output:
+        mx.model.save_checkpoint(args.output, 0, qsym, qarg_params, qaux_params)
+
+    ops = collections.Counter(node['op'] for node in json.loads(qsym.tojson())['nodes'])
+    print('int8 nodes: %s' % ', '.join('%s x%d' % (op, count) for op, count in sorted(ops.items())
+                                        if 'quantize' in op or op.startswith('_sg_mkldnn')))
+    print('%-6s %10s %12s %14s' % ('', 'accuracy', 'latency ms', 'samples/s'))
+    for name, result in (('fp32', fp32), ('int8', int8)):
+        print('%-6s %9.2f%% %12.1f %14.1f' % (name, result['accuracy'] * 100, result['latency'] * 1000,
+                                               result['throughput']))
+    print('accuracy delta %+.2f%%, top-1 agreement %.2f%%, speedup %.2fx' % (
+        (int8['accuracy'] - fp32['accuracy']) * 100,
+        np.mean(np.argmax(fp32['probs'], axis=-1) == np.argmax(int8['probs'], axis=-1)) * 100,
+        fp32['latency'] / int8['latency']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# coding: utf-8
+
+import math
+import time
+import resource
+import argparse
+
+import numpy as np
+import mxnet as mx
+
+import data_utils
+from pointcnn_infer import Predictor
+
+# Splits a scene into block_size x block_size columns of the xy plane, starting every stride.
+# Returns the (x, y) origin of each non-empty block and the indices of its points. With stride < block_size
+# blocks overlap, each point falls in up to ceil(block_size / stride) ** 2 of them.
+def split_blocks(points, block_size, stride):
+    xy_min = np.min(points[:, :2], axis=0)
+    xy = points[:, :2] - xy_min
+    cells = np.floor(xy / stride).astype(np.int64)  # the last block starting at or before each point
+    grid_height = np.max(cells[:, 1]) + 1
+    overlap = int(math.ceil(block_size / stride))
+
+    block_ids = []
+    point_indices = []
+    for dx in range(overlap):
+        for dy in range(overlap):
+            blocks = cells - (dx, dy)
+            inside = np.all(blocks >= 0, axis=1) & np.all(xy < blocks * stride + block_size, axis=1)
+            block_ids.append(blocks[inside, 0] * grid_height + blocks[inside, 1])
+            point_indices.append(np.flatnonzero(inside))
+    block_ids = np.concatenate(block_ids)
+    point_indices = np.concatenate(point_indices)
+
+    order = np.argsort(block_ids, kind='stable')
+    block_ids = block_ids[order]
+    point_indices = point_indices[order]
+    splits = np.flatnonzero(np.diff(block_ids)) + 1
+    block_ids = block_ids[np.concatenate([[0], splits])]
+    origins = np.stack((block_ids // grid_height, block_ids % grid_height), axis=-1) * stride + xy_min
+    return origins, np.split(point_indices, splits)
+
+# Cuts the points of a block into (sample_count, sample_num) samples covering every point at least once: a
+# random permutation of them, completed with random points of the block. Samples are centered on the block in
+# xy and start at z_min in z. Returns the sample points and the scene indices of those points.
+def block_samples(points, point_indices, origin, block_size, z_min, sample_num):
+    sample_count = int(math.ceil(len(point_indices) / sample_num))
+    pad = sample_count * sample_num - len(point_indices)
+    indices = np.concatenate([np.random.permutation(point_indices), np.random.choice(point_indices, pad)])
+    indices = np.reshape(indices, (sample_count, sample_num))
+    center = np.array([origin[0] + block_size / 2, origin[1] + block_size / 2, z_min], dtype=np.float32)
+    return (points[indices, :3] - center).astype(np.float32), indices
+
+# Per-point segmentation of scenes too large for a single pass. The scene is split into overlapping blocks,
+# blocks are cut into samples on num_workers threads and run batch_size samples at a time, so memory only
+# depends on block and batch size. Probabilities of points seen by several samples are averaged.
+class SceneSegmenter(object):
+    def __init__(self, predictor, block_size, block_stride, num_workers=2, depth=4):
+        self.predictor = predictor
+        self.block_size = block_size
+        self.block_stride = block_stride
+        self.num_workers = num_workers
+        self.depth = depth
+
+    def batches(self, points):
+        origins, block_indices = split_blocks(points, self.block_size, self.block_stride)
+        z_min = np.min(points[:, 2])
+        sample_num = self.predictor.sample_num
+        batch_size = self.predictor.batch_size
+
+        def prepare(block_idx):
+            return block_samples(points, block_indices[block_idx], origins[block_idx], self.block_size, z_min,
+                                 sample_num)
+
+        prefetcher = data_utils.Prefetcher(prepare, range(len(block_indices)), self.depth, self.num_workers)
+        pending_points = []
+        pending_indices = []
+        pending_num = 0
+        for block_points, block_point_indices in prefetcher:
+            pending_points.append(block_points)
+            pending_indices.append(block_point_indices)
+            pending_num += len(block_points)
+            while pending_num >= batch_size:
+                batch_points = np.concatenate(pending_points)
+                batch_indices = np.concatenate(pending_indices)
+                yield batch_points[:batch_size], batch_indices[:batch_size]
+                pending_points = [batch_points[batch_size:]]
+                pending_indices = [batch_indices[batch_size:]]
+                pending_num -= batch_size
+        if pending_num > 0:
+            # the last batch is completed with copies of its first sample, whose results are dropped
+            batch_points = np.concatenate(pending_points)
+            batch_indices = np.concatenate(pending_indices)
+            fill = np.zeros((batch_size - pending_num), dtype=np.int64)
+            yield np.concatenate([batch_points, batch_points[fill]]), batch_indices
+
+    # points: (N, >=3) scene, returns (N, num_class) probabilities
+    def segment(self, points):
+        scores = np.zeros((len(points), self.predictor.num_class), dtype=np.float32)
+        counts = np.zeros((len(points)), dtype=np.int32)
+
+        def merge(probs, indices):
+            probs = probs.asnumpy()[:len(indices)].reshape(-1, probs.shape[-1])
+            np.add.at(scores, indices.ravel(), probs)
+            np.add.at(counts, indices.ravel(), 1)
+
+        # the next batch is pushed to the engine before the results of the previous one are merged
+        previous = None
+        for batch_points, batch_indices in self.batches(points):
+            probs = self.predictor.forward(batch_points)
+            if previous is not None:
+                merge(*previous)
+            previous = (probs, batch_indices)
+        if previous is not None:
+            merge(*previous)
+        return scores / np.maximum(counts, 1)[:, None]
+
+# boxes of random size standing on a floor, as a stand-in for a scanned room
+def synthetic_scene(point_num, extent):
+    floor_num = point_num // 4
+    floor = np.stack([np.random.uniform(0, extent, floor_num), np.random.uniform(0, extent, floor_num),
+                      np.zeros(floor_num)], axis=-1)
+    box_num = max(point_num // 5000, 1)
+    box_min = np.random.uniform(0, extent - 1, (box_num, 3)) * (1, 1, 0)
+    box_size = np.random.uniform(0.2, 1, (box_num, 3))
+    box_idx = np.random.randint(box_num, size=point_num - floor_num)
+    boxes = box_min[box_idx] + np.random.uniform(0, 1, (len(box_idx), 3)) * box_size[box_idx]
+    return np.concatenate([floor, boxes]).astype(np.float32)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params', '-p', help='Path to segmentation parameters, random weights if not given')
+    parser.add_argument('--scene', '-s', help='Path to a .npy or .txt scene with xyz in the first columns, '
+                                              'synthetic if not given')
+    parser.add_argument('--point_num', '-n', help='Points of the synthetic scene', type=int, default=100000)
+    parser.add_argument('--extent', '-e', help='Side of the synthetic scene (m)', type=float, default=4.0)
+    parser.add_argument('--batch_size', '-b', help='Inference batch size', type=int)
+    parser.add_argument('--sample_num', help='Points per sample', type=int)
+    parser.add_argument('--workers', '-w', help='Threads cutting blocks into samples', type=int, default=2)
+    parser.add_argument('--output', '-o', help='Path to save the per-point labels (.txt)')
+    args = parser.parse_args()
+    print(args)
+
+    from setting_s3dis import setting
+    if args.scene is None:
+        points = synthetic_scene(args.point_num, args.extent)
+    elif args.scene.endswith('.npy'):
+        points = np.load(args.scene)
+    else:
+        points = np.loadtxt(args.scene)
+    predictor = Predictor(setting, args.params, batch_size=args.batch_size, sample_num=args.sample_num,
+                          ctx=mx.cpu(), task='segmentation')
+    segmenter = SceneSegmenter(predictor, setting.block_size, setting.block_stride, args.workers)
+
+    start = time.time()
+    probs = segmenter.segment(points)
+    elapsed = time.time() - start
+    labels = np.argmax(probs, axis=-1)
+    if args.output:
+        np.savetxt(args.output, labels, fmt='%d')
+
+    print('{} points in {:.3f}s: {:.1f} points/s, max RSS {:.1f}MB'.format(
+        len(points), elapsed, len(points) / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ import sys
 import h5py
 import random
 import argparse
+import multiprocessing
 import numpy as np
 from mnist import MNIST
 from datetime import datetime
@@ -18,11 +19,71 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import data_utils
 
 
+# images: (n, 784) pixel values, returns (n, point_num, 4) points with the pixel value as 4th channel
+def convert_images(images, point_num, rng):
+    images = images.astype(np.float64)
+    image_num = images.shape[0]
+    pixel_idx = np.empty((image_num, point_num), dtype=np.int64)
+
+    # images with enough pixels: weighted sampling without replacement, as the top point_num of
+    # log(u) / weight keys (Efraimidis-Spirakis)
+    no_replace = np.count_nonzero(images, axis=1) >= point_num
+    if np.any(no_replace):
+        weights = images[no_replace]
+        with np.errstate(divide='ignore'):
+            keys = np.log(rng.random_sample(weights.shape)) / weights
+        keys[weights == 0] = -np.inf
+        pixel_idx[no_replace] = np.argsort(-keys, axis=1)[:, :point_num]
+
+    # the others: weighted sampling with replacement, by inverting each image's cdf in a single
+    # searchsorted over the images laid end to end
+    replace = ~no_replace
+    if np.any(replace):
+        weights = images[replace]
+        rows = np.arange(weights.shape[0])[:, None]
+        cdf = np.cumsum(weights, axis=1) / np.sum(weights, axis=1, keepdims=True)
+        cdf[:, -1] = 1.0
+        u = rng.random_sample((weights.shape[0], point_num))
+        pixel_idx[replace] = np.searchsorted((cdf + rows).ravel(), (u + rows).ravel(), side='right').reshape(
+            u.shape) - rows * images.shape[1]
+
+    rows = np.arange(image_num)[:, None]
+    y = rng.random_sample(images.shape)[rows, pixel_idx] * 1e-6
+    points = np.stack((pixel_idx // 28, y, pixel_idx % 28), axis=-1).astype(np.float64)  # (n, point_num, 3)
+    pixels = images[rows, pixel_idx][..., None] / 255 - 0.5
+
+    points_min = np.amin(points, axis=1, keepdims=True)
+    points_max = np.amax(points, axis=1, keepdims=True)
+    points_center = (points_min + points_max) / 2
+    scale = np.amax(points_max - points_min, axis=-1, keepdims=True) / 2
+    points = (points - points_center) * (0.8 / scale)
+    return np.concatenate((points, pixels), axis=-1).astype(np.float32)
+
+
+# converts one batch of images and writes it to its own h5 file, runs in a worker process
+def convert_shard(args):
+    images, labels, filename_h5, point_num, seed, folder_ply, idx_img_begin = args
+    data = convert_images(images, point_num, np.random.RandomState(seed))
+
+    print('{}-Saving {}...'.format(datetime.now(), filename_h5))
+    with h5py.File(filename_h5, 'w') as file:
+        chunk_num = min(64, len(data))
+        file.create_dataset('data', data=data, chunks=(chunk_num,) + data.shape[1:])
+        file.create_dataset('label', data=labels, chunks=(chunk_num,))
+
+    if folder_ply is not None:
+        for idx, sample in enumerate(data):
+            filename_pts = os.path.join(folder_ply, '{:06d}.ply'.format(idx_img_begin + idx))
+            data_utils.save_ply(sample[:, :3], filename_pts, colors=np.tile(sample[:, 3:], (1, 3)) + 0.5)
+    return int(np.count_nonzero(images))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--folder', '-f', help='Path to data folder')
     parser.add_argument('--point_num', '-p', help='Point number for each sample', type=int, default=256)
     parser.add_argument('--save_ply', '-s', help='Convert .pts to .ply', action='store_true')
+    parser.add_argument('--workers', '-w', help='Number of worker processes', type=int, default=multiprocessing.cpu_count())
     args = parser.parse_args()
     print(args)
 
@@ -34,58 +95,27 @@ def main():
     mnist_data = MNIST(folder_mnist)
     mnist_train_test = [(mnist_data.load_training(), 'train'), (mnist_data.load_testing(), 'test')]
 
-    data = np.zeros((batch_size, args.point_num, 4))
-    label = np.zeros((batch_size), dtype=np.int32)
+    pool = multiprocessing.Pool(args.workers)
     for ((images, labels), tag) in mnist_train_test:
-        idx_h5 = 0
+        images = np.array(images, dtype=np.uint8)
+        labels = np.array(labels, dtype=np.int32)
+        folder_ply = os.path.join(folder_pts, tag) if args.save_ply else None
         filename_filelist_h5 = os.path.join(os.path.dirname(folder_mnist), '%s_files.txt' % tag)
-        point_num_total = 0
+
+        tasks = []
+        for idx_h5, idx_img_begin in enumerate(range(0, len(images), batch_size)):
+            idx_img_end = min(idx_img_begin + batch_size, len(images))
+            filename_h5 = os.path.join(os.path.dirname(folder_mnist), '%s_%d.h5' % (tag, idx_h5))
+            tasks.append((images[idx_img_begin:idx_img_end], labels[idx_img_begin:idx_img_end], filename_h5,
+                          args.point_num, random.randint(0, 2 ** 31 - 1), folder_ply, idx_img_begin))
+        point_num_total = sum(pool.map(convert_shard, tasks))
+
         with open(filename_filelist_h5, 'w') as filelist_h5:
-            for idx_img, image in enumerate(images):
-                points = []
-                pixels = []
-                for idx_pixel, pixel in enumerate(image):
-                    if pixel == 0:
-                        continue
-                    x = idx_pixel // 28
-                    z = idx_pixel % 28
-                    points.append((x, random.random() * 1e-6, z))
-                    pixels.append(pixel)
-                point_num_total = point_num_total + len(points)
-                pixels_sum = sum(pixels)
-                probs = [pixel / pixels_sum for pixel in pixels]
-                indices = np.random.choice(list(range(len(points))), size=args.point_num,
-                                           replace=(len(points) < args.point_num), p=probs)
-                points_array = np.array(points)[indices]
-                pixels_array_1d = (np.array(pixels)[indices].astype(np.float32) / 255) - 0.5
-                pixels_array = np.expand_dims(pixels_array_1d, axis=-1)
-
-                points_min = np.amin(points_array, axis=0)
-                points_max = np.amax(points_array, axis=0)
-                points_center = (points_min + points_max) / 2
-                scale = np.amax(points_max - points_min) / 2
-                points_array = (points_array - points_center) * (0.8 / scale)
-
-                if args.save_ply:
-                    filename_pts = os.path.join(folder_pts, tag, '{:06d}.ply'.format(idx_img))
-                    data_utils.save_ply(points_array, filename_pts, colors=np.tile(pixels_array, (1, 3)) + 0.5)
-
-                idx_in_batch = idx_img % batch_size
-                data[idx_in_batch, ...] = np.concatenate((points_array, pixels_array), axis=-1)
-                label[idx_in_batch] = labels[idx_img]
-                if ((idx_img + 1) % batch_size == 0) or idx_img == len(images) - 1:
-                    item_num = idx_in_batch + 1
-                    filename_h5 = os.path.join(os.path.dirname(folder_mnist), '%s_%d.h5' % (tag, idx_h5))
-                    print('{}-Saving {}...'.format(datetime.now(), filename_h5))
-                    filelist_h5.write('./%s_%d.h5\n' % (tag, idx_h5))
-
-                    file = h5py.File(filename_h5, 'w')
-                    file.create_dataset('data', data=data[0:item_num, ...])
-                    file.create_dataset('label', data=label[0:item_num, ...])
-                    file.close()
-
-                    idx_h5 = idx_h5 + 1
+            for idx_h5 in range(len(tasks)):
+                filelist_h5.write('./%s_%d.h5\n' % (tag, idx_h5))
         print('Average point number in each sample is : %f!' % (point_num_total / len(images)))
+    pool.close()
+    pool.join()
 
 
 if __name__ == '__main__':
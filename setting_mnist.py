@@ -0,0 +1,78 @@
+# coding: utf-8
+
+import math
+
+from dotdict import DotDict
+
+########################### Settings ###############################
+setting = DotDict()
+
+setting.num_class = 10
+
+setting.sample_num = 160
+# number of distinct point counts to train with, None binds one graph per sampled count
+setting.sample_num_buckets = 8
+
+setting.batch_size = 32
+# devices every batch is split over, e.g. ['cpu(0)', 'cpu(1)'], batch_size must be a multiple of their number;
+# None trains on gpu(0), or on the CPU when there is no GPU
+setting.contexts = None
+# kvstore aggregating the gradients, 'local', 'device' or 'dist_sync'. None is 'dist_sync' in the worker
+# processes started by launch_local.py, where batch_size is per worker, and 'local' otherwise
+setting.kvstore = None
+# memory budget in bytes, when set batch_size becomes the largest one costmodel predicts to fit in it
+setting.memory_budget = None
+
+# number of batches prepared ahead by the data pipeline and threads preparing them, 0 prepares them inline
+setting.prefetch_depth = 4
+setting.prefetch_workers = 2
+
+setting.num_epochs = 2048
+# parameters are saved as <model_prefix>-<epoch>.params at the end of every epoch
+setting.model_prefix = 'pointcnn_mnist'
+# steps run imperatively under a StageProfiler before training, printing per-layer stage times and writing
+# a Chrome trace to <model_prefix>_profile.json, 0 disables profiling
+setting.profile_steps = 0
+
+setting.jitter = 0.01
+setting.jitter_val = 0.01
+
+setting.rotation_range = [0, math.pi / 18, 0, 'g']
+setting.rotation_range_val = [0, 0, 0, 'u']
+setting.order = 'rxyz'
+
+setting.scaling_range = [0.05, 0.05, 0.05, 'g']
+setting.scaling_range_val = [0, 0, 0, 'u']
+
+x = 2
+
+# K, D, P, C
+setting.xconv_params = [(8, 1, -1, 16 * x),
+                (8, 2, -1, 32 * x),
+                (8, 4, -1, 48 * x),
+                (12, 4, 120, 64 * x),
+                (12, 6, 120, 80 * x)]
+
+# C, dropout_rate
+setting.fc_params = [(64 * x, 0.0), (32 * x, 0.5)]
+
+setting.with_fps = False
+# 'slice' (first P points), 'fps', 'curvature', 'voxel' (one point per voxel-grid cell) or 'random' for the
+# xconv layers with P != -1, one for all of them or a list with one per xconv layer; with_fps decides when None
+setting.sampling = None
+
+# 'dense' or 'kdtree'
+setting.knn_backend = 'dense'
+# (query_tile, point_tile) for the dense backend, or a per-layer distance memory budget in bytes
+setting.knn_tile_size = None
+setting.knn_max_bytes = None
+# run knn once for consecutive xconv layers sharing the same points and queries
+setting.share_knn = True
+# run the X-transformation convolution on channel-last (N, P, K, C) data as a FullyConnected, without the
+# transposes to and from NCHW; same parameters and outputs
+setting.channel_last = False
+
+setting.data_dim = 3
+setting.with_X_transformation = True
+setting.sorting_method = None
+###################################################################
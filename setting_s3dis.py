@@ -0,0 +1,56 @@
+# coding: utf-8
+
+import math
+
+from dotdict import DotDict
+
+########################### Settings ###############################
+setting = DotDict()
+
+setting.num_class = 13
+
+setting.sample_num = 2048
+
+setting.batch_size = 8
+
+# scenes are cut into block_size x block_size columns on the xy plane, one every block_stride
+setting.block_size = 1.5
+setting.block_stride = 0.75
+
+x = 2
+
+# K, D, P, C
+setting.xconv_params = [(8, 1, -1, 32 * x),
+                (12, 2, 768, 32 * x),
+                (16, 2, 384, 64 * x),
+                (16, 4, 128, 128 * x)]
+
+# K, D, pts_layer_idx, qrs_layer_idx
+setting.xdconv_params = [(16, 4, 3, 3),
+                 (16, 2, 3, 2),
+                 (12, 2, 2, 1),
+                 (8, 2, 1, 0)]
+
+# C, dropout_rate
+setting.fc_params = [(32 * x, 0.0), (32 * x, 0.5)]
+
+setting.with_fps = False
+# 'slice' (first P points), 'fps', 'curvature', 'voxel' (one point per voxel-grid cell) or 'random' for the
+# xconv layers with P != -1, one for all of them or a list with one per xconv layer; with_fps decides when None
+setting.sampling = None
+
+# 'dense' or 'kdtree'
+setting.knn_backend = 'dense'
+# (query_tile, point_tile) for the dense backend, or a per-layer distance memory budget in bytes
+setting.knn_tile_size = None
+setting.knn_max_bytes = None
+# run knn once for consecutive xconv layers sharing the same points and queries
+setting.share_knn = True
+# run the X-transformation convolution on channel-last (N, P, K, C) data as a FullyConnected, without the
+# transposes to and from NCHW; same parameters and outputs
+setting.channel_last = False
+
+setting.data_dim = 3
+setting.with_X_transformation = True
+setting.sorting_method = None
+###################################################################
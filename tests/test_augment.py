@@ -0,0 +1,32 @@
+# coding: utf-8
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pointcnn import get_xforms
+
+
+def test_rotation_is_not_diagonal():
+    np.random.seed(0)
+    xforms, rotations = get_xforms(8, rotation_range=[0, 0.5, 0, 'u'], scaling_range=[0.1, 0.1, 0.1, 'u'])
+    off_diagonal = xforms * (1 - np.eye(3))
+    assert np.all(np.max(np.abs(off_diagonal), axis=(1, 2)) > 1e-6)
+    # scaling then rotating: the rotation is recovered up to the per-axis scale factors
+    scales = np.linalg.norm(xforms, axis=2)
+    assert np.allclose(xforms / scales[:, :, None], rotations)
+
+
+def test_unit_scaling_keeps_rotation():
+    np.random.seed(0)
+    xforms, rotations = get_xforms(8, rotation_range=[0.5, 0.5, 0.5, 'u'], order='rxyz')
+    assert np.allclose(xforms, rotations)
+    assert np.allclose(np.matmul(xforms, np.transpose(xforms, (0, 2, 1))), np.eye(3))
+
+
+def test_scaling_only_is_diagonal():
+    np.random.seed(0)
+    xforms, _ = get_xforms(8, scaling_range=[0.1, 0.2, 0.3, 'g'])
+    assert np.allclose(xforms * (1 - np.eye(3)), 0)
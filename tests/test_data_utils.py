@@ -0,0 +1,36 @@
+# coding: utf-8
+
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_utils import H5Dataset
+
+
+def write_filelist(folder, sizes):
+    names = []
+    for i, size in enumerate(sizes):
+        name = 'part%d.h5' % i
+        with h5py.File(os.path.join(folder, name), 'w') as data:
+            data['data'] = np.full((size, 4, 3), i, dtype=np.float32)
+            data['label'] = np.arange(size, dtype=np.int64) + 100 * i
+        names.append(name)
+    filelist = os.path.join(folder, 'files.txt')
+    with open(filelist, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    return filelist
+
+
+def test_h5dataset_indexing(tmp_path):
+    dataset = H5Dataset(write_filelist(str(tmp_path), [3, 2]))
+    assert len(dataset) == 5
+    assert dataset[3][1] == 100
+    assert dataset[-1][1] == 101
+    assert dataset[-5][1] == 0
+    for idx in (5, -6):
+        with pytest.raises(IndexError):
+            dataset[idx]
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from voxelop import voxel_grid_sampling_one, voxel_grid_sampling_cpu
+
+
+def check_indices(idx, n, m):
+    assert idx.shape == (m,) and idx.dtype == np.int32
+    assert len(np.unique(idx)) == m
+    assert idx.min() >= 0 and idx.max() < n
+
+
+def test_uniform_cube():
+    rng = np.random.RandomState(0)
+    points = rng.uniform(size=(2048, 3)).astype(np.float32)
+    check_indices(voxel_grid_sampling_one(points, 768, rng=rng), 2048, 768)
+
+
+# a single far point blows the bounding box up, the cells of the rest of the cloud have to shrink by orders
+# of magnitude without a dense table over the whole box
+def test_far_outlier():
+    rng = np.random.RandomState(0)
+    points = rng.uniform(size=(2048, 3)).astype(np.float32)
+    points[0] = 1e4
+    check_indices(voxel_grid_sampling_one(points, 768, rng=rng), 2048, 768)
+
+
+def test_distant_clusters():
+    rng = np.random.RandomState(0)
+    points = np.concatenate([rng.normal(0, 1e-3, size=(1024, 3)), rng.normal(1e3, 1e-3, size=(1024, 3))])
+    idx = voxel_grid_sampling_one(points.astype(np.float32), 768, rng=rng)
+    check_indices(idx, 2048, 768)
+    # both clusters are covered
+    assert 256 < np.sum(idx < 1024) < 512
+
+
+def test_fewer_points_than_samples():
+    rng = np.random.RandomState(0)
+    idx = voxel_grid_sampling_cpu(rng.uniform(size=(2, 100, 3)), 128)
+    assert idx.shape == (2, 128)
+    assert all(len(np.unique(row)) == 100 for row in idx)
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import numpy as np
+import mxnet as mx
+
+# Input points: (n, 3)
+# Output idxs (m), one random point of every occupied cell of a voxel grid, completed with random other points
+# or cut to m at random when the grid has fewer or more than m occupied cells.
+# The cell size starts at the one that gives m cells over the bounding box of the non-flat axes. Clouds on
+# surfaces, around outliers or in distant clusters occupy fewer cells than that, so the size shrinks until at
+# least m cells are occupied, by at most max_shrink per pass. Occupied cells are found by sorting the cell keys
+# of the points, O(n log n) per pass whatever the number of cells of the grid.
+def voxel_grid_sampling_one(points, m, max_passes=8, max_shrink=4.0, rng=np.random):
+    n = len(points)
+    if n <= m:
+        return np.concatenate([rng.permutation(n), rng.choice(n, m - n)]).astype(np.int32)
+    xyz_min = np.min(points, axis=0)
+    extent = np.max(points, axis=0) - xyz_min
+    flat = extent <= 1e-6 * max(np.max(extent), 1e-12)
+    dim = max(int(np.sum(~flat)), 1)
+    cell = (np.prod(extent[~flat]) / m) ** (1.0 / dim) if np.any(~flat) else 1.0
+    order = rng.permutation(n)  # the first point of a cell in this order is kept, a random one
+    points = points[order]
+    for _ in range(max_passes):
+        grid = np.where(flat, 1, np.floor(extent / cell).astype(np.int64) + 1)
+        cells = np.floor((points - xyz_min) / cell).astype(np.int64)
+        cells = np.minimum(np.where(flat, 0, cells), grid - 1)
+        keys = (cells[:, 0] * grid[1] + cells[:, 1]) * grid[2] + cells[:, 2]
+        _, first = np.unique(keys, return_index=True)
+        selected = order[first]
+        if len(selected) >= m:
+            break
+        # occupied cells grow like cell ** -2 on surfaces
+        cell /= min(np.sqrt(m / len(selected)), max_shrink)
+    if len(selected) >= m:
+        return rng.choice(selected, m, replace=False).astype(np.int32)
+    remaining = np.ones(n, dtype=bool)
+    remaining[selected] = False
+    fill = rng.choice(np.flatnonzero(remaining), m - len(selected), replace=False)
+    return np.concatenate([selected, fill]).astype(np.int32)
+
+# Input dataset: (b, n, 3)
+# Ouput idxs (b, m)
+def voxel_grid_sampling_cpu(dataset, m):
+    return np.stack([voxel_grid_sampling_one(points, m) for points in dataset])
+
+class VoxelGridSampling(mx.operator.CustomOp):
+    def __init__(self, npoints):
+        super(VoxelGridSampling, self).__init__()
+        self.npoints = npoints
+
+    def forward(self, is_train, req, in_data, out_data, aux):
+        if req[0] == "null":
+            return
+        x = in_data[0]
+        y = voxel_grid_sampling_cpu(x.asnumpy(), self.npoints)
+        self.assign(out_data[0], req[0], mx.nd.array(y, ctx=x.context, dtype=np.int32))
+
+    def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+        self.assign(in_grad[0], req[0], 0)
+
+@mx.operator.register("VoxelGridSampling")
+class VoxelGridSamplingProp(mx.operator.CustomOpProp):
+    def __init__(self, npoints=0):
+        super(VoxelGridSamplingProp, self).__init__(need_top_grad=False)
+
+        self.npoints = int(npoints)
+
+    def list_arguments(self):
+        return ['in_data']
+
+    def list_outputs(self):
+        return ['output']
+
+    def infer_shape(self, in_shape):
+        output_shape = (in_shape[0][0], self.npoints)
+        return in_shape, [output_shape], []
+
+    def infer_type(self, in_type):
+        return in_type, [np.int32], []
+
+    def create_operator(self, ctx, in_shapes, in_dtypes):
+        return VoxelGridSampling(self.npoints)